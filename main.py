@@ -1,16 +1,22 @@
 from src.nn_encoding import *
-from scripts.train import train, eval
+from scripts.train import train, eval, EVAL_BATCH_SIZE
 from scripts.dataloader import MNIST, cifar10
-from src.evolution import evolution
+from src.evolution import evolution, HALVING_BUDGETS
+from src.evaluation import benchmark_cpu_perf
+from src.islands import run_islands, TOPOLOGIES
+from src.runlog import RunLog, make_batch, write_csv
+from scripts.early_stopping import default_policy
 
 import csv
 import sys
+import functools
+import signal
 from os import listdir
 import time
 
 from plot_results import *
 
-def run_evolution(dataset, population_size = 2, num_generations=2, batch_size=4, subpath =''):
+def run_evolution(dataset, population_size = 2, num_generations=2, batch_size=4, subpath ='', workers=1, threads_per_worker=1, ledger=None, fuse=1, early_stop=False, halving=False, inherit_weights=False, prescreen=None, surrogate_pool=1, pareto=None, eval_batch_size=EVAL_BATCH_SIZE, cpu_perf=False, compile=None, resume=False, broker=None, steady_state=False):
     '''
     input: 
         - the dataset we want to train the population on
@@ -18,36 +24,99 @@ def run_evolution(dataset, population_size = 2, num_generations=2, batch_size=4,
         - the number of generations we want to train
         - the batch_size associated to trainloader and testloader
         - subpath: the path where we want to save the results
+        - workers: the number of processes used to train the population
+        - threads_per_worker: the number of torch threads of each worker process
+        - ledger: SQLite file where the scores are shared between runs, known networks are not trained again
+        - fuse: how many networks are trained together on the same minibatches (only without workers)
+        - early_stop: abort the training of diverging, flat or clearly worse networks
+        - halving: score the population with successive halving over HALVING_BUDGETS
+        - inherit_weights: the offspring start from the weights of their parents and are only fine-tuned
+        - prescreen: proxy (naswot, synflow, grad_norm) used to discard the worst new networks before training
+        - surrogate_pool: how many offspring are bred for each place in the population, a surrogate model keeps the best
+        - pareto: cost (params, macs, latency) minimized together with the accuracy by an NSGA-II selection,
+                  the Pareto front of the whole run is saved in the results
+        - eval_batch_size: the minibatch size of the inference on the test set
+        - cpu_perf: train with channels last tensors, bfloat16 autocast and fused optimizer steps; the speedup and
+                    the accuracy delta are measured on a few networks of the initial population and saved in the results
+        - compile: compile the networks with TorchScript (script) or torch.compile (compile), networks with
+                   the same architecture reuse the compiled graph
+        - resume: continue from the checkpoint written after the last completed generation in the results path,
+                  the checkpoint is removed when the run is complete
+        - broker: spool directory where the networks are published, they are trained by the workers started
+                  with python -m src.broker DIR on any node sharing the directory
+        - steady_state: no generations, each offspring replaces the worst network as soon as it is scored and the
+                        workers never wait for each other; a "generation" of the results is population_size arrivals
     '''
-    # create a population of random networks
-    curr_env = evolution(population_size, holdout=0.6, mating=True, dataset=dataset, batch_size=batch_size)
-    
     # run evolution and write result on file
     path = 'results/'
     if subpath:
         path += subpath 
         if not os.path.isdir(path):
             os.mkdir(path)
+
+    # create a population of random networks
+    curr_env = evolution(population_size, holdout=0.6, mating=True, dataset=dataset, batch_size=batch_size,
+                         workers=workers, threads_per_worker=threads_per_worker, ledger=ledger, fuse=fuse,
+                         early_stop=default_policy() if early_stop else None,
+                         halving=HALVING_BUDGETS if halving else None, inherit_weights=inherit_weights,
+                         prescreen=prescreen, surrogate_pool=surrogate_pool,
+                         selection='nsga2' if pareto else 'accuracy', cost_objective=pareto or 'params',
+                         archive=f'{path}/pareto_archive.pkl' if pareto else None, eval_batch_size=eval_batch_size,
+                         cpu_perf=cpu_perf, compile=compile,
+                         resume=f'{path}/checkpoint.pkl' if resume else None, broker=broker)
+
+    if cpu_perf and curr_env.resumed is None:
+        perf = benchmark_cpu_perf(curr_env.population, curr_env.trainloader, curr_env.testloader, batch_size,
+                                  eval_batch_size=eval_batch_size)
+        report = (f"CPU performance mode on {perf['networks']} networks (bfloat16: {perf['bf16']}): "
+                  f"training {perf['base_time']:.1f}s -> {perf['perf_time']:.1f}s, speedup {perf['speedup']:.2f}x, "
+                  f"accuracy delta {perf['accuracy_delta']:+.2f}%")
+        print(report)
+        with open(f'{path}/cpu_perf.txt', 'w+') as f:
+            f.write(report + "\n")
      
-    res = []
-
-    generations = num_generations
-    for i in range(generations):
-        gen = curr_env.generation()
-        this_generation_best, best_score = curr_env.get_best_organism()
-        best_net = this_generation_best
-        print("Generation ", i , "'s best network accuracy: ", best_score, "%")
-        for j in range(population_size):
-            res.append([i, j, gen[j]['score'], gen[j]['len'], best_score, best_net._len()])
-            # save encoding of best network for each generation
-            net_obj_py = open(f"results/best_net_encoding_res/gen{i:003}.pkl", "wb")
-            pickle.dump(gen[j]['genotype'], net_obj_py)
-            net_obj_py.close()
+    # the statistics and the genotypes of each generation are appended to the run log in the background
+    first_generation = 0
+    best_net, best_score = curr_env.best_organism, curr_env.best_score
+    if curr_env.resumed is not None:
+        first_generation = curr_env.resumed['generation'] + 1
+        runlog = RunLog(f'{path}/runlog', curr_env.resumed['generation'], curr_env.resumed.get('pending', ()))
+        print("Resuming from generation ", first_generation)
+    else:
+        runlog = RunLog(f'{path}/runlog')
+
+    # the scheduler sends SIGTERM before killing the job: stop the workers and close the ledger on the way out,
+    # the checkpoint of the last completed generation is already on disk
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    terminated = True
+    try:
+        generations = num_generations
+        for i in range(first_generation, generations):
+            if steady_state:
+                curr_env.steady_state(population_size)
+                gen = curr_env.population_stats()
+                this_generation_best, best_score = curr_env.best_organism, curr_env.best_score
+            else:
+                gen = curr_env.generation()
+                this_generation_best, best_score = curr_env.get_best_organism()
+            best_net = this_generation_best
+            print("Generation ", i , "'s best network accuracy: ", best_score, "%")
+            print("Scores reused from cache: ", curr_env.cache_hits, ", from ledger: ", curr_env.ledger_hits, ", trainings aborted: ", len(curr_env.aborted),
+                  ", discarded by the proxy: ", curr_env.screened_out, ", rejected by the shape analysis: ", curr_env.rejected)
+            print("Duplicate offspring bred again: ", curr_env.duplicates, " of ", curr_env.bred, f" ({100 * curr_env.duplicate_rate():.1f}%)")
+            runlog.append(i, make_batch(i, gen, best_score, best_net))
+
+            # the generations still in the queue of the run log are saved with the checkpoint
+            curr_env.save_checkpoint(f'{path}/checkpoint.pkl', generation=i, pending=runlog.pending())
+        terminated = False
+    finally:
+        curr_env.close(wait=not terminated)
+        runlog.close()
 
     # test last generation best organism
     trainloader , testloader, _, _, _ = dataset(batch_size, test = True)
-    model = train(Net(best_net), trainloader , batch_size, all=True)
-    acc = eval(model, testloader)
+    model = train(Net(best_net), trainloader , batch_size, all=True, cpu_perf=cpu_perf)
+    acc = eval(model, testloader, eval_batch_size, cpu_perf)
     
     original_stdout = sys.stdout # Save a reference to the original standard output
     with open(f'{path}/best_organism', 'w+') as d:
@@ -58,30 +127,98 @@ def run_evolution(dataset, population_size = 2, num_generations=2, batch_size=4,
 
     # save best organism object in specific subfolder
     net_obj_py = open(f"{path}/best_organism.pkl", "wb")
-    pickle.dump(best_net, net_obj_py)
+    pickle.dump(best_net.without_weights(), net_obj_py)
     net_obj_py.close()
 
-    # save results to file
-    f = open(f'{path}/all_generations_data.csv', 'w+', newline='')
-    # create the csv writer
-    writer = csv.writer(f)
-
-    fieldnames = ['generation', 'individual', 'accuracy', 'num_layers', 'best_accuracy', 'best_num_layers']
-    writer.writerow(fieldnames)
-    
+    # the run log as a csv file, the cost columns come from Net_encoding.cost, activation memory is for a
+    # forward pass of batch_size samples
     print("Best accuracy obtained: ", best_score)
-    writer.writerows(res)
-    f.close() 
+    write_csv(f'{path}/runlog', f'{path}/all_generations_data.csv')
+
+    # save the scores of every rung of successive halving, generation and individual are the same of all_generations_data.csv
+    if curr_env.halving:
+        with open(f'{path}/rung_scores.csv', 'w+', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['generation', 'rung', 'train_fraction', 'individual', 'accuracy'])
+            for i, rungs in enumerate(curr_env.rung_scores):
+                for rung, rung_scores in enumerate(rungs):
+                    writer.writerows([i, rung, curr_env.halving[rung], j, score] for j, score in rung_scores.items())
+
+    # the trade-off between accuracy and cost found during the whole run, not only the best network
+    if curr_env.archive is not None:
+        curr_env.archive.write_csv(f'{path}/pareto_front.csv')
+        print(f"Pareto front (accuracy, {pareto}):")
+        for key, (genotype, accuracy, cost) in curr_env.archive.front():
+            print(f"  {accuracy}%  {cost}  {genotype._len()} layers  {key[:10]}")
+
+    # the run is complete: a later run with --resume in the same path starts from a new population
+    if os.path.exists(f'{path}/checkpoint.pkl'):
+        os.remove(f'{path}/checkpoint.pkl')
 
 
 
 def print_usage():
-    print("Usage: python main.py [dataset] [population_size] [num_generations] [batch_size] [subpath]")
+    print("Usage: python main.py [dataset] [population_size] [num_generations] [batch_size] [subpath] [--workers N] [--threads N] [--ledger FILE] [--preload] [--fuse N] [--early-stop] [--halving] [--inherit] [--prescreen naswot|synflow|grad_norm] [--surrogate-pool N] [--pareto params|macs|latency] [--eval-batch N] [--cpu-perf] [--compile script|compile] [--resume] [--broker DIR] [--steady-state] [--islands N] [--migrate-every M] [--migrants K] [--topology ring|full|star|none]")
     # add more info about which datasets are available
     sys.exit(1)
 
+def pop_option(name, default, type=int):
+    "remove an option and its value from sys.argv, so that the positional arguments are left unchanged"
+    if name not in sys.argv:
+        return default
+    idx = sys.argv.index(name)
+    if idx + 1 >= len(sys.argv) or (type == int and not sys.argv[idx + 1].isdigit()):
+        print_usage()
+    value = type(sys.argv[idx + 1])
+    del sys.argv[idx:idx + 2]
+    return value
+
+def pop_flag(name):
+    "remove a flag from sys.argv and tell if it was given"
+    if name not in sys.argv:
+        return False
+    sys.argv.remove(name)
+    return True
+
 if __name__ == "__main__":
    
+    # read options provided by user
+    workers = pop_option('--workers', 1)
+    threads_per_worker = pop_option('--threads', 1)
+    ledger = pop_option('--ledger', None, type=str)
+    preload = pop_flag('--preload')
+    fuse = pop_option('--fuse', 1)
+    early_stop = pop_flag('--early-stop')
+    halving = pop_flag('--halving')
+    inherit_weights = pop_flag('--inherit')
+    prescreen = pop_option('--prescreen', None, type=str)
+    surrogate_pool = pop_option('--surrogate-pool', 1)
+    pareto = pop_option('--pareto', None, type=str)
+    eval_batch_size = pop_option('--eval-batch', EVAL_BATCH_SIZE)
+    cpu_perf = pop_flag('--cpu-perf')
+    compile = pop_option('--compile', None, type=str)
+    resume = pop_flag('--resume')
+    broker = pop_option('--broker', None, type=str)
+    steady_state = pop_flag('--steady-state')
+    islands = pop_option('--islands', 1)
+    migrate_every = pop_option('--migrate-every', 5)
+    migrants = pop_option('--migrants', 2)
+    topology = pop_option('--topology', 'ring', type=str)
+    if topology not in TOPOLOGIES:
+        print_usage()
+    if compile not in (None, 'script', 'compile'):
+        print_usage()
+    if pareto not in (None, 'params', 'macs', 'latency'):
+        print_usage()
+    # the islands evolve by generations from a new random population, each one in its own process
+    if islands > 1 and (pareto or resume or broker or steady_state):
+        print("--pareto, --resume, --broker and --steady-state can not be used with --islands")
+        print_usage()
+    # the offspring of the steady state get the full budget and replace the worst network by accuracy
+    if steady_state and (pareto or halving or prescreen or surrogate_pool > 1):
+        print("--pareto, --halving, --prescreen and --surrogate-pool can not be used with --steady-state")
+        print_usage()
+
     # read arguments provided by user
     args = len(sys.argv) 
 
@@ -114,15 +251,28 @@ if __name__ == "__main__":
         num_generations = 2
         batch_size = 4
         subpath = ''
+
+    # serve the minibatches from tensors decoded once, instead of converting each image at every step
+    if preload:
+        dataset = functools.partial(dataset, preload=True)
     
     
     # run evolution
     print(f"\n\n Evolution of a population of networks: \n dataset: {dataset}, population_size: {population_size}, number of generation: {num_generations},  batch size: {batch_size}, path: {subpath} \n\n")
     print("Running Device:", torch.device("cuda" if torch.cuda.is_available() else "cpu") )
-    run_evolution(dataset, population_size, num_generations, batch_size, subpath = subpath) 
+    if islands > 1:
+        # one population per process, the statistics of each island and of all of them are saved in results/subpath
+        run_islands(dataset, islands, population_size, num_generations, batch_size, subpath = subpath, topology = topology,
+                    every = migrate_every, migrants = migrants, workers = workers, threads_per_worker = threads_per_worker,
+                    ledger = ledger, fuse = fuse, early_stop = default_policy() if early_stop else None,
+                    halving = HALVING_BUDGETS if halving else None, inherit_weights = inherit_weights, prescreen = prescreen,
+                    surrogate_pool = surrogate_pool, eval_batch_size = eval_batch_size, cpu_perf = cpu_perf, compile = compile)
+        sys.exit(0)
+
+    run_evolution(dataset, population_size, num_generations, batch_size, subpath = subpath, workers = workers, threads_per_worker = threads_per_worker, ledger = ledger, fuse = fuse, early_stop = early_stop, halving = halving, inherit_weights = inherit_weights, prescreen = prescreen, surrogate_pool = surrogate_pool, pareto = pareto, eval_batch_size = eval_batch_size, cpu_perf = cpu_perf, compile = compile, resume = resume, broker = broker, steady_state = steady_state) 
     
     read_results(subpath)
-    plot_net_representation(f"results/{subpath}")
+    plot_net_representation(subpath)
 
     # check best network saved
     """ filename = f"results/{subpath}/best_organism.pkl"
@@ -17,5 +17,32 @@ if __name__ == "__main__":
    # print("TEST OF MUTATION AT GA LEVEL...")
    # test_mutation_GA_level(trainloader)
 
+   #print("TEST GENOTYPE HASH...")
+   #test_genotype_hash()
+
+   #print("TEST COPY ON WRITE OF THE GENOTYPES...")
+   #test_copy_on_write()
+
+   #print("TEST GRAMMAR REGISTRY...")
+   #test_grammar_registry()
+
+   #print("TEST COMPACT GENOTYPE...")
+   #test_compact_genotype()
+
+   #print("TEST RUN LOG...")
+   #test_runlog()
+
+   #print("BENCHMARK OF THE CROSSOVER...")
+   #benchmark_crossover()
+
+   #print("TEST STATIC SHAPE ANALYSIS...")
+   #test_shape_analysis(trainloader)
+
+   #print("TEST PARETO SELECTION...")
+   #test_pareto()
+
+   #print("TEST SPOOL BROKER...")
+   #test_broker(MNIST)
+
    print("TEST EVOLUTION...")
    test_evolution(trainloader)
@@ -4,6 +4,7 @@ import os
 import matplotlib.pyplot as plt
 
 from src.nn_encoding import Net_encoding
+from src.runlog import chunks, load_chunk, genotypes
 import numpy as np
 import pickle
 
@@ -91,7 +92,8 @@ def plot_results(data, path):
 
         if i % population_size == 0 and i != 0:
             curr_gen_score = y[i - population_size: i]
-            curr_gen = data[i - population_size: i]
+            # data has the header in its first row, y does not
+            curr_gen = data[i - population_size + 1: i + 1]
             index = np.argmax(curr_gen_score)
             best_score = np.amax(curr_gen_score)
             best_net_acc.append(best_score)
@@ -135,13 +137,12 @@ def plot_net_representation(subpath):
         if not os.path.isdir(path):
             os.mkdir(path)
 
-    # take network encoding from file of results
-    for filename in os.listdir(f"{init_path}/best_net_encoding_res"):
-        if filename.endswith('.pkl'):
-            with open(f'{init_path}/best_net_encoding_res/{filename}', 'rb') as f:
-                net_encoding = pickle.load(f)
-                gen_num = int(filename[-7:-4])
-                net_encoding.draw(gen_num, path)
+    # take the network encoding of the best individual of each generation from the run log
+    runlog = f"{init_path}/runlog"
+    for name in chunks(runlog) if os.path.isdir(runlog) else []:
+        batch = load_chunk(runlog, name)
+        best = int(np.argmax(batch['accuracy']))
+        genotypes(batch)[best].draw(int(batch['generation'][best]), path)
 
     # Build GIF
     """ frames = []
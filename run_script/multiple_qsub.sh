@@ -2,6 +2,6 @@
 
 #if the queqe is empty, it's better to parallelise the multiple runs in order to use more GPUs at the same time
 
-qsub run_orfeo.sh 1 3
-qsub run_orfeo.sh 4 6
-qsub run_orfeo.sh 7 10
\ No newline at end of file
+qsub -F "1 3" run_orfeo.sh
+qsub -F "4 6" run_orfeo.sh
+qsub -F "7 10" run_orfeo.sh
\ No newline at end of file
@@ -33,8 +33,9 @@ conda activate deep_le
 #     start=$1
 #     end=$2
 # fi
-start=1
-end=1
+# the runs of this job, e.g. qsub -F "1 3" run_orfeo.sh; each run has its own results path and checkpoint
+start=${1:-1}
+end=${2:-1}
 touch run_script/running_info
 
 for (( i=$start; i<=$end; i++ ))
@@ -44,10 +45,12 @@ do
     gen_size=50
     batch_size=4
 
-    PATH_TO_SAVE="${dataset}/pop${pop_size}_gen${gen_size}_run20"
+    PATH_TO_SAVE="${dataset}/pop${pop_size}_gen${gen_size}_run${i}"
     mkdir -p "results/$PATH_TO_SAVE"
   
-    python main.py $dataset $pop_size $gen_size $batch_size $PATH_TO_SAVE >> run_script/running_info
+    # scores already computed by the other runs are read from the shared ledger,
+    # a job resubmitted after the walltime continues from the checkpoint of its last generation
+    python main.py $dataset $pop_size $gen_size $batch_size $PATH_TO_SAVE --ledger results/fitness_ledger.sqlite --resume >> run_script/running_info
     echo "run ${dataset} ${i} finished" >> run_script/running_info
 done
 
@@ -4,11 +4,91 @@ import torchvision
 import torchvision.transforms as transforms
 import os
 
+# normalization applied by both datasets
+MEAN = 0.1307
+STD = 0.3081
+
+
+class TensorLoader:
+    "Serve minibatches by slicing tensors which are already decoded and normalized, like a DataLoader without workers."
+    def __init__(self, data, targets, batch_size=4, shuffle=False):
+        self.dataset = torch.utils.data.TensorDataset(data, targets)
+        self.data = data
+        self.targets = targets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        n = len(self.data)
+        # one permutation per epoch, each minibatch is gathered with a single index_select
+        order = torch.randperm(n) if self.shuffle else None
+        for start in range(0, n, self.batch_size):
+            if order is None:
+                yield self.data[start:start + self.batch_size], self.targets[start:start + self.batch_size]
+            else:
+                idx = order[start:start + self.batch_size]
+                yield self.data[idx], self.targets[idx]
+
+    def __len__(self):
+        return (len(self.data) + self.batch_size - 1) // self.batch_size
+
+
+def preload_split(dataset, cache_file=None):
+    """
+    decode and normalize a whole torchvision dataset once, as ToTensor and Normalize would do on each sample
+    dataset: MNIST or CIFAR10 torchvision dataset, without transform
+    cache_file: if given, the tensors are saved there and read back by the next calls
+    """
+    if cache_file is not None and os.path.exists(cache_file):
+        return torch.load(cache_file)
+
+    data = torch.as_tensor(dataset.data)
+    if data.dim() == 3:    # MNIST: N x H x W
+        data = data.unsqueeze(1)
+    else:                  # CIFAR10: N x H x W x C
+        data = data.permute(0, 3, 1, 2)
+    data = data.float().div_(255).sub_(MEAN).div_(STD).contiguous()
+    targets = torch.as_tensor(dataset.targets, dtype=torch.long)
+
+    if cache_file is not None:
+        # write and rename, so that a concurrent run never reads half a file
+        torch.save((data, targets), cache_file + f'.{os.getpid()}.tmp')
+        os.replace(cache_file + f'.{os.getpid()}.tmp', cache_file)
+    return data, targets
+
+
+def preloaded_loaders(torch_dataset, name, split, batch_size, test, cache):
+    "trainloader and testloader of preloaded tensors, with the same split used by the torchvision loaders"
+    cache_file = (lambda s: f'./data/{name}_{s}.pt') if cache else (lambda s: None)
+
+    data, targets = preload_split(torch_dataset(root='./data', train=True, download=True), cache_file('train'))
+    if test:
+        test_data, test_targets = preload_split(torch_dataset(root='./data', train=False, download=True), cache_file('test'))
+        train_data, train_targets = data, targets
+    else:
+        # random_split only depends on the lengths and the generator, the indices are the same as on the dataset
+        train_idx, test_idx = torch.utils.data.random_split(range(len(data)), split, generator=torch.Generator().manual_seed(42))
+        train_idx, test_idx = torch.tensor(train_idx.indices), torch.tensor(test_idx.indices)
+        train_data, train_targets = data[train_idx], targets[train_idx]
+        test_data, test_targets = data[test_idx], targets[test_idx]
+
+    trainloader = TensorLoader(train_data, train_targets, batch_size=batch_size, shuffle=True)
+    testloader = TensorLoader(test_data, test_targets, batch_size=batch_size, shuffle=False)
+    return trainloader, testloader
+
+
+def cifar10(batch_size=4, test = False, preload = False, cache = True):
+    """
+    preload: decode and normalize the whole dataset once and serve the minibatches from tensors
+    cache: with preload, keep the tensors in ./data so that the next runs do not decode them again
+    """
+    if preload:
+        trainloader, testloader = preloaded_loaders(torchvision.datasets.CIFAR10, 'cifar10', [40000, 10000], batch_size, test, cache)
+        return trainloader, testloader, 32, 10, 3
 
-def cifar10(batch_size=4, test = False):
     transform = transforms.Compose([
                         transforms.ToTensor(),
-                transforms.Normalize((0.1307,), (0.3081,)), ])
+                transforms.Normalize((MEAN,), (STD,)), ])
 
     # We download the train and the test dataset in the given root and applying the given transforms
     trainset = torchvision.datasets.CIFAR10(root='./data', train=True,  download=True, transform=transform)
@@ -16,7 +96,8 @@ def cifar10(batch_size=4, test = False):
     if test:
          testset = torchvision.datasets.CIFAR10(root='./data', train=False,  download=True, transform=transform)
     else:
-        trainset, testset = torch.utils.data.random_split(trainset, [40000, 10000])
+        # fixed seed: every process (e.g. the workers of a PoolEvaluator) must see the same split
+        trainset, testset = torch.utils.data.random_split(trainset, [40000, 10000],  generator=torch.Generator().manual_seed(42) )
 
 
     # dataloaders
@@ -37,10 +118,18 @@ def cifar10(batch_size=4, test = False):
     return trainloader, testloader, input_size, n_classes, input_channels
 
 
-def MNIST(batch_size=4, test = False):
+def MNIST(batch_size=4, test = False, preload = False, cache = True):
+    """
+    preload: decode and normalize the whole dataset once and serve the minibatches from tensors
+    cache: with preload, keep the tensors in ./data so that the next runs do not decode them again
+    """
+    if preload:
+        trainloader, testloader = preloaded_loaders(torchvision.datasets.MNIST, 'MNIST', [50000, 10000], batch_size, test, cache)
+        return trainloader, testloader, 28, 10, 1
+
     transform = transforms.Compose([
                         transforms.ToTensor(),
-                transforms.Normalize((0.1307,), (0.3081,)), ])
+                transforms.Normalize((MEAN,), (STD,)), ])
 
     # We download the train and the test dataset in the given root and applying the given transforms
     trainset = torchvision.datasets.MNIST(root='./data', train=True,  download=True, transform=transform)
@@ -0,0 +1,146 @@
+import math
+import numpy as np
+
+'''
+
+This file contains the policies used by train to abort a network before the end of its budget.
+A policy is started at the beginning of each training, then it receives the loss of every step
+and returns the reason to stop, or None to go on.
+
+'''
+
+# the loss is smoothed with an exponential moving average before any decision
+SMOOTHING = 0.95
+
+
+class EarlyStop:
+    "Base policy: smooths the loss, never stops."
+    def __init__(self, check_every=50, min_steps=200):
+        '''
+        check_every: the number of steps between two decisions
+        min_steps: no decision is taken before this number of steps
+        '''
+        self.check_every = check_every
+        self.min_steps = min_steps
+
+    def start(self, total_steps):
+        self.total_steps = total_steps
+        self.smoothed = None
+        self.first = None
+        self.history = []   # (step, smoothed loss) at each check
+
+    def update(self, step, loss):
+        if not math.isfinite(loss):
+            return None
+        self.smoothed = loss if self.smoothed is None else SMOOTHING * self.smoothed + (1 - SMOOTHING) * loss
+        if step % self.check_every == 0:
+            if self.first is None:
+                self.first = self.smoothed
+            self.history.append((step, self.smoothed))
+            if step >= self.min_steps:
+                return self.on_check(step, loss)
+        return None
+
+    def on_check(self, step, loss):
+        return None
+
+
+class DivergenceStop(EarlyStop):
+    "Stop when the loss is NaN or infinite, or when it grows well above its initial value."
+    def __init__(self, factor=2.0, check_every=50, min_steps=0):
+        super().__init__(check_every, min_steps)
+        self.factor = factor
+
+    def update(self, step, loss):
+        # NaN is checked at every step, it will never recover
+        if not math.isfinite(loss):
+            return "diverged: loss is not finite"
+        return super().update(step, loss)
+
+    def on_check(self, step, loss):
+        if self.first is not None and self.smoothed > self.factor * self.first:
+            return f"diverged: loss {self.smoothed:.3f} is {self.factor}x the initial {self.first:.3f}"
+        return None
+
+
+class PlateauStop(EarlyStop):
+    "Stop when the smoothed loss did not improve for patience checks, e.g. a Softmax before CrossEntropyLoss."
+    def __init__(self, patience=5, min_delta=0.01, check_every=50, min_steps=200):
+        '''
+        patience: the number of checks without improvement before stopping
+        min_delta: the relative improvement of the best loss which resets the patience
+        '''
+        super().__init__(check_every, min_steps)
+        self.patience = patience
+        self.min_delta = min_delta
+
+    def start(self, total_steps):
+        super().start(total_steps)
+        self.best = math.inf
+        self.waiting = 0
+
+    def on_check(self, step, loss):
+        if self.smoothed < self.best * (1 - self.min_delta):
+            self.best = self.smoothed
+            self.waiting = 0
+        else:
+            self.waiting += 1
+        if self.waiting >= self.patience:
+            return f"plateau: loss {self.smoothed:.3f} did not improve for {self.patience} checks"
+        return None
+
+
+class CurveStop(EarlyStop):
+    """
+    Fit the smoothed loss as a + b*log(step) and extrapolate it to the end of the training,
+    stop when the prediction is worse than the reference (the median final loss of the current generation).
+    """
+    def __init__(self, margin=0.1, check_every=50, min_steps=300):
+        '''
+        margin: the prediction must exceed the reference by this fraction to stop
+        '''
+        super().__init__(check_every, min_steps)
+        self.margin = margin
+        self.reference = None
+
+    def on_check(self, step, loss):
+        if self.reference is None or len(self.history) < 3:
+            return None
+        steps, losses = zip(*self.history)
+        b, a = np.polyfit(np.log(steps), losses, 1)
+        predicted = a + b * math.log(self.total_steps)
+        if predicted > self.reference * (1 + self.margin):
+            return f"curve: predicted final loss {predicted:.3f} above the generation median {self.reference:.3f}"
+        return None
+
+
+class AnyStop(EarlyStop):
+    "Stop as soon as one of the policies stops."
+    def __init__(self, *policies):
+        self.policies = policies
+
+    @property
+    def reference(self):
+        return next((p.reference for p in self.policies if isinstance(p, CurveStop)), None)
+
+    @reference.setter
+    def reference(self, value):
+        for p in self.policies:
+            if isinstance(p, CurveStop):
+                p.reference = value
+
+    def start(self, total_steps):
+        for p in self.policies:
+            p.start(total_steps)
+
+    def update(self, step, loss):
+        for p in self.policies:
+            reason = p.update(step, loss)
+            if reason is not None:
+                return reason
+        return None
+
+
+def default_policy():
+    "divergence, plateau and curve extrapolation together"
+    return AnyStop(DivergenceStop(), PlateauStop(), CurveStop())
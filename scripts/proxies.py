@@ -0,0 +1,96 @@
+import torch
+import torch.nn as nn
+import numpy as np
+
+'''
+
+This file contains training-free proxies of the accuracy of a network, computed on its random
+initialization with a single forward (and backward) pass. Higher is better for all of them.
+
+'''
+
+# number of samples used to compute a proxy
+PROXY_BATCH = 64
+# activations whose input is used by NASWOT to build the binary codes
+ACTIVATIONS = (nn.ReLU, nn.Sigmoid, nn.Tanh)
+
+
+def proxy_batch(trainloader, size=PROXY_BATCH):
+    "concatenate minibatches of the trainloader until size samples are collected"
+    inputs, labels = [], []
+    collected = 0
+    for x, y in trainloader:
+        inputs.append(x)
+        labels.append(y)
+        collected += len(x)
+        if collected >= size:
+            break
+    return torch.cat(inputs)[:size], torch.cat(labels)[:size]
+
+
+def naswot(model, inputs, labels=None):
+    '''
+    Neural Architecture Search WithOut Training: the log-determinant of the kernel of the binary
+    activation patterns, networks which separate the inputs well have a higher score.
+    '''
+    codes = []
+    def hook(module, args):
+        codes.append((args[0].detach().flatten(1) > 0).float())
+    handles = [m.register_forward_pre_hook(hook) for m in model.modules() if isinstance(m, ACTIVATIONS)]
+    try:
+        with torch.no_grad():
+            model(inputs)
+    finally:
+        for h in handles:
+            h.remove()
+
+    if not codes:
+        return -np.inf
+    c = torch.cat(codes, dim=1).double()
+    # hamming similarity between every pair of inputs
+    kernel = c @ c.t() + (1 - c) @ (1 - c).t()
+    sign, logdet = torch.linalg.slogdet(kernel)
+    return logdet.item() if sign > 0 else -np.inf
+
+
+def synflow(model, inputs, labels=None):
+    '''
+    Synaptic flow: sum of |theta * dR/dtheta| where R is the output of the network with all the
+    weights in absolute value on an input of ones; it does not depend on the data, only on its shape.
+    '''
+    # an input of ones has no variance, batch norm must use its running statistics
+    model.eval()
+    model.double()
+    with torch.no_grad():
+        for p in model.state_dict().values():
+            p.abs_()
+    model.zero_grad()
+    output = model(torch.ones_like(inputs, dtype=torch.double))
+    torch.sum(output).backward()
+    score = sum((p * p.grad).abs().sum().item() for p in model.parameters() if p.grad is not None)
+    model.float()
+    model.train()
+    return score
+
+
+def grad_norm(model, inputs, labels):
+    "sum of the norms of the gradients of the loss with respect to each parameter"
+    model.zero_grad()
+    loss = nn.CrossEntropyLoss()(model(inputs), labels)
+    loss.backward()
+    return sum(p.grad.norm().item() for p in model.parameters() if p.grad is not None)
+
+
+PROXIES = {'naswot': naswot, 'synflow': synflow, 'grad_norm': grad_norm}
+
+
+def compute_proxy(name, model, inputs, labels):
+    "the proxy of the model, -inf if the network fails on the inputs or the score is not finite"
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+    try:
+        score = PROXIES[name](model, inputs.to(device), labels.to(device))
+    except RuntimeError as e:
+        print("The proxy could not be computed:\n", e)
+        return -np.inf
+    return score if np.isfinite(score) else -np.inf
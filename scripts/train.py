@@ -3,31 +3,63 @@ from tqdm import tqdm
 import torch.nn as nn
 import torch
 import torch.optim as optim
+import math
+import time
+import copy
+from scripts.early_stopping import SMOOTHING
+from scripts.dataloader import TensorLoader
 
 DEBUG = 0
 
-def train(model, trainloader, batch_size = 4, epochs = 1, all = False):
+def bf16_supported():
+    "bfloat16 is faster than float32 on the CPU only with native instructions (AVX512-BF16 or AMX)"
+    return any(getattr(torch.cpu, name, lambda: False)() for name in ('_is_avx512_bf16_supported', '_is_amx_tile_supported'))
+
+def autocast(device, cpu_perf = False):
+    "bfloat16 autocast of the forward pass in the CPU performance mode, a no-op otherwise"
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=cpu_perf and device.type == 'cpu' and bf16_supported())
+
+def make_optimizer(model, cpu_perf = False):
+    "SGD of every training, in the CPU performance mode all the parameters are updated by a single fused kernel"
+    if cpu_perf:
+        try:
+            return optim.SGD(model.parameters(), lr=0.001, momentum=0.9, fused=True)
+        except (RuntimeError, TypeError):
+            return optim.SGD(model.parameters(), lr=0.001, momentum=0.9, foreach=True)
+    return optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
+
+def train(model, trainloader, batch_size = 4, epochs = 1, all = False, early_stop = None, fraction = 0.1, cpu_perf = False):
     '''
     model: the model to train
     trainloader: the dataloader for the training data
     batch_size: the batch size used to construct the trainloader
     epochs: the number of epochs to train the model
     inspect: the number of items to be used for training before printing the loss
+    early_stop: a policy of scripts.early_stopping which can abort the training,
+                the outcome is written in model.training_log
+    fraction: the fraction of the training set used in each epoch, if not all
+    cpu_perf: channels last tensors, bfloat16 autocast (if the CPU supports it) and fused optimizer steps
     '''
     device=torch.device("cuda" if torch.cuda.is_available() else "cpu") # the device type is automatically chosen
+    memory_format = torch.channels_last if cpu_perf else torch.contiguous_format
 
-    model.to(device)
+    model.to(device, memory_format=memory_format)
     if all:
         inspected = len(trainloader.dataset)
         epochs = 2
     else:
-        inspected = len(trainloader.dataset) / 10  # the number of items to be used for training before printing the loss
+        inspected = len(trainloader.dataset) * fraction  # the number of items to be used for training before printing the loss
 
     iterations = int(inspected / batch_size)
     
     # define the loss function and the optimizer
     criterion = nn.CrossEntropyLoss()
-    optimizer = optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
+    optimizer = make_optimizer(model, cpu_perf)
+
+    model.training_log = {'loss': None, 'stopped': None, 'steps': 0}
+    if early_stop is not None:
+        early_stop.start(epochs * iterations)
+    step = 0
 
     for epoch in range(epochs):  # loop over the dataset multiple times
 
@@ -37,21 +69,110 @@ def train(model, trainloader, batch_size = 4, epochs = 1, all = False):
         for i in range(iterations):
             try:
                 inputs, labels = next(dataloader_iterator)
-                inputs, labels = inputs.to(device), labels.to(device)
+                inputs, labels = inputs.to(device, memory_format=memory_format), labels.to(device)
                 # zero the parameter gradients
                 optimizer.zero_grad()
 
                 # calculate outputs by running images through the network
-                outputs = model(inputs)
-                loss = criterion(outputs, labels)
+                with autocast(device, cpu_perf):
+                    outputs = model(inputs)
+                    loss = criterion(outputs, labels)
                 loss.backward()
                 optimizer.step()
+                step += 1
+
+                # reading the loss forces a synchronization, it is done only if it is needed
+                if early_stop is not None:
+                    value = loss.item()
+                    log = model.training_log
+                    if math.isfinite(value):
+                        log['loss'] = value if log['loss'] is None else SMOOTHING * log['loss'] + (1 - SMOOTHING) * value
+                    log['stopped'] = early_stop.update(step, value)
+                    if log['stopped'] is not None:
+                        break
 
             except StopIteration:
                 print("StopIteration, not enough data")
-            
+
+        if model.training_log['stopped'] is not None:
+            break
+
+    model.training_log['steps'] = step
+    model.to(memory_format=torch.contiguous_format)
     return model
 
+def train_many(models, trainloader, batch_size = 4, epochs = 1, all = False, early_stop = None, fraction = 0.1, cpu_perf = False):
+    '''
+    Train several models on the same stream of minibatches: each minibatch is loaded and moved
+    to the device once and then used by every model, each one with its own optimizer.
+    models: the list of models to train
+    early_stop: a policy of scripts.early_stopping, each model is followed by its own copy of it;
+                an aborted model leaves the group, the others go on
+    fraction: the same of train, or a list with the fraction of each model
+    the other parameters are the same of train
+    '''
+    device=torch.device("cuda" if torch.cuda.is_available() else "cpu") # the device type is automatically chosen
+    memory_format = torch.channels_last if cpu_perf else torch.contiguous_format
+
+    for model in models:
+        model.to(device, memory_format=memory_format)
+    fractions = fraction if isinstance(fraction, (list, tuple)) else [fraction] * len(models)
+    if all:
+        inspected = [len(trainloader.dataset)] * len(models)
+        epochs = 2
+    else:
+        inspected = [len(trainloader.dataset) * f for f in fractions]
+
+    # a model leaves the group when it reaches its own number of iterations
+    iterations = [int(n / batch_size) for n in inspected]
+
+    criterion = nn.CrossEntropyLoss()
+    optimizers = [make_optimizer(model, cpu_perf) for model in models]
+    # the policies keep the state of a single training
+    policies = [copy.deepcopy(early_stop) for _ in models]
+
+    for model, policy, n in zip(models, policies, iterations):
+        model.training_log = {'loss': None, 'stopped': None, 'steps': 0}
+        if policy is not None:
+            policy.start(epochs * n)
+
+    for epoch in range(epochs):
+
+        dataloader_iterator = iter(trainloader)
+
+        for i in range(max(iterations, default=0)):
+            active = [j for j, model in enumerate(models) if i < iterations[j] and model.training_log['stopped'] is None]
+            if not active:
+                break
+            try:
+                inputs, labels = next(dataloader_iterator)
+                inputs, labels = inputs.to(device, memory_format=memory_format), labels.to(device)
+
+                for j in active:
+                    model, optimizer, policy = models[j], optimizers[j], policies[j]
+                    optimizer.zero_grad()
+                    with autocast(device, cpu_perf):
+                        outputs = model(inputs)
+                        loss = criterion(outputs, labels)
+                    loss.backward()
+                    optimizer.step()
+                    log = model.training_log
+                    log['steps'] += 1
+
+                    # the same bookkeeping of train
+                    if policy is not None:
+                        value = loss.item()
+                        if math.isfinite(value):
+                            log['loss'] = value if log['loss'] is None else SMOOTHING * log['loss'] + (1 - SMOOTHING) * value
+                        log['stopped'] = policy.update(log['steps'], value)
+
+            except StopIteration:
+                print("StopIteration, not enough data")
+
+    for model in models:
+        model.to(memory_format=torch.contiguous_format)
+    return models
+
 '''
 This is a simple function to check the model is properly built and correctly working  
 '''
@@ -79,30 +200,114 @@ def test_model(model, trainloader):
             
     return True
 
-    
-def eval(model, testloader):
+
+# minibatch size of the inference on the test set, it does not depend on the one used for training
+EVAL_BATCH_SIZE = 1024
+
+def inference_batches(testloader, eval_batch_size = EVAL_BATCH_SIZE):
+    "the same test set of testloader, served in minibatches of eval_batch_size"
+    if eval_batch_size is None or eval_batch_size == testloader.batch_size:
+        return testloader
+    if isinstance(testloader, TensorLoader):
+        return TensorLoader(testloader.data, testloader.targets, eval_batch_size)
+    return torch.utils.data.DataLoader(testloader.dataset, batch_size=eval_batch_size, shuffle=False,
+                                       num_workers=testloader.num_workers)
+
+def evaluate(models, testloader, eval_batch_size = EVAL_BATCH_SIZE, cpu_perf = False):
     '''
-    model: the model to evaluate
+    Evaluate one or more models in inference mode on the same stream of minibatches, the predictions are
+    counted on the device and read back once at the end.
+    models: a model or a list of models
     testloader: the dataloader for the test data
+    eval_batch_size: the minibatch size of the inference, None to keep the one of testloader
+    cpu_perf: bfloat16 autocast of the inference, if the CPU supports it
+    return: for each model a dict with the exact accuracy (percentage), the number of correct predictions,
+            the number of samples and the per-class counts of correct predictions and of samples
     '''
     device=torch.device("cuda" if torch.cuda.is_available() else "cpu") # the device type is automatically chosen
-    correct = 0
-    total = 0
-    # since we're not training, we don't need to calculate the gradients for our outputs
-    with torch.no_grad():
-        # for data in tqdm(testloader, desc="evaluating"):
-        for data in testloader:
-            images, labels = data
-            images, labels = images.to(device), labels.to(device)
-            # calculate outputs by running images through the network
-            outputs = model.forward(images)
-            # the class with the highest energy is what we choose as prediction
-            _, predicted = torch.max(outputs.data, 1)
-            total += labels.size(0)
-            correct += (predicted == labels).sum().item()
-
-    accuracy = 100 * correct // total
+    single = isinstance(models, nn.Module)
+    if single:
+        models = [models]
+
+    for model in models:
+        model.to(device)
+        # batch norm must use its running statistics and must not update them on the test set
+        model.eval()
+        model.to(memory_format=torch.channels_last)
+
+    correct = [None] * len(models)
+    per_class_total = None
+    # a TorchScript graph already profiled for training records the autograd state even in inference mode
+    scripted = any(isinstance(m, torch.jit.ScriptModule) for model in models for m in model.modules())
+    with torch.no_grad() if scripted else torch.inference_mode():
+        for images, labels in inference_batches(testloader, eval_batch_size):
+            images = images.to(device, memory_format=torch.channels_last)
+            labels = labels.to(device)
+            for k, model in enumerate(models):
+                # the class with the highest energy is what we choose as prediction
+                with autocast(device, cpu_perf):
+                    outputs = model(images)
+                predicted = outputs.argmax(1)
+                hits = torch.bincount(labels[predicted == labels], minlength=outputs.shape[1])
+                correct[k] = hits if correct[k] is None else correct[k] + hits
+            seen = torch.bincount(labels, minlength=len(correct[0]))
+            per_class_total = seen if per_class_total is None else per_class_total + seen
+
+    for model in models:
+        model.to(memory_format=torch.contiguous_format)
+        model.train()
+
+    per_class_total = per_class_total.tolist()
+    total = sum(per_class_total)
+    results = []
+    for hits in correct:
+        hits = hits.tolist()
+        results.append({'accuracy': 100 * sum(hits) / total, 'correct': sum(hits), 'total': total,
+                        'per_class_correct': hits, 'per_class_total': per_class_total})
+    return results[0] if single else results
+
+def eval(model, testloader, eval_batch_size = EVAL_BATCH_SIZE, cpu_perf = False):
+    '''
+    model: the model to evaluate
+    testloader: the dataloader for the test data
+    eval_batch_size: the minibatch size of the inference
+    cpu_perf: bfloat16 autocast of the inference, if the CPU supports it
+    '''
+    result = evaluate(model, testloader, eval_batch_size, cpu_perf)
+    accuracy = 100 * result['correct'] // result['total']
     print(f'Accuracy of the network on the 10000 test images: {accuracy} %')
     return accuracy
 
 
+def eval_many(models, testloader, eval_batch_size = EVAL_BATCH_SIZE, cpu_perf = False):
+    '''
+    Evaluate several models on the same stream of minibatches, return the list of accuracies
+    models: the list of models to evaluate
+    testloader: the dataloader for the test data
+    eval_batch_size: the minibatch size of the inference
+    cpu_perf: bfloat16 autocast of the inference, if the CPU supports it
+    '''
+    accuracies = [100 * result['correct'] // result['total'] for result in evaluate(models, testloader, eval_batch_size, cpu_perf)]
+    for accuracy in accuracies:
+        print(f'Accuracy of the network on the 10000 test images: {accuracy} %')
+    return accuracies
+
+
+def measure_latency(model, input_shape, input_channels, repeats = 20):
+    '''
+    median wall time in milliseconds of the inference of a single image on the CPU
+    input_shape: the size of the square input image
+    input_channels: the number of channels of the input image
+    '''
+    model.to("cpu")
+    model.eval()
+    x = torch.randn(1, input_channels, input_shape, input_shape)
+    times = []
+    with torch.no_grad():
+        model(x)    # warm up
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(x)
+            times.append(time.perf_counter() - start)
+    model.train()
+    return 1000 * sorted(times)[len(times) // 2]
@@ -0,0 +1,242 @@
+from src.evaluation import score_genotype
+import torch
+
+from concurrent.futures import Future
+import threading
+import pickle
+import socket
+import time
+import uuid
+import sys
+import os
+
+'''
+
+This file contains a broker based on a spool directory, shared by a coordinator (the evolution) and by
+worker processes started on any node which can see the directory:
+    tasks/      genotypes waiting for a worker, one pickle per task
+    running/    tasks claimed by a worker, renamed to <task>@<worker>.pkl
+    results/    scores written back by the workers
+    workers/    one heartbeat file per worker, touched while the worker is alive
+A task whose worker stops sending heartbeats is moved back to tasks/ and trained by another worker.
+
+Start a worker with:  python -m src.broker SPOOL_DIR [--threads N]
+
+'''
+
+SPOOL_DIRS = ('tasks', 'running', 'results', 'workers')
+# seconds between two heartbeats of a worker
+HEARTBEAT_INTERVAL = 10
+# a worker whose heartbeat did not change for this number of seconds is considered lost
+STALE_AFTER = 60
+# seconds between two scans of the spool directory
+POLL_INTERVAL = 0.5
+
+
+def write_atomic(path, obj):
+    "pickle obj to path through a temporary file, readers never see a partial file"
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(path + '.tmp', path)
+
+def pickles(directory):
+    "names of the complete pickles of a spool directory, oldest task first"
+    return sorted(name[:-4] for name in os.listdir(directory) if name.endswith('.pkl'))
+
+
+class SpoolEvaluator:
+    "Score genotypes on workers of any node, exchanging tasks and results through a spool directory."
+    def __init__(self, spool, dataset, batch_size, stale_after=STALE_AFTER):
+        '''
+        spool: the directory shared with the workers, it is created if needed and emptied
+        dataset: the dataset function (MNIST, cifar10), it must give the same split in every worker
+        batch_size: the batch size used to construct the trainloader and testloader
+        stale_after: the seconds without heartbeats after which the tasks of a worker are reassigned
+        '''
+        self.spool = spool
+        self.stale_after = stale_after
+        for d in SPOOL_DIRS:
+            os.makedirs(os.path.join(spool, d), exist_ok=True)
+        # tasks and results of a previous coordinator are dropped, the workers keep running
+        for d in ('tasks', 'running', 'results'):
+            for name in os.listdir(os.path.join(spool, d)):
+                os.remove(os.path.join(spool, d, name))
+        if os.path.exists(os.path.join(spool, 'stop')):
+            os.remove(os.path.join(spool, 'stop'))
+
+        # the session tells the workers when the configuration changed
+        self.session = uuid.uuid4().hex[:8]
+        write_atomic(os.path.join(spool, 'config.pkl'), {'session': self.session, 'dataset': dataset, 'batch_size': batch_size})
+
+        self.futures = {}       # task -> Future of (score, training log)
+        self.heartbeats = {}    # worker -> (mtime of its heartbeat, local time when it last changed)
+        self.requeued = 0
+        self.submitted = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.poller = threading.Thread(target=self._poll, daemon=True)
+        self.poller.start()
+
+    def submit(self, modelcode, **options):
+        "publish a task, the Future gets the result of score_genotype(**options) from a worker"
+        future = Future()
+        with self.lock:
+            task = f"{self.session}-{self.submitted:08d}"
+            self.submitted += 1
+            self.futures[task] = future
+        write_atomic(os.path.join(self.spool, 'tasks', task + '.pkl'), (modelcode, options))
+        future.add_done_callback(lambda f: self.withdraw(task) if f.cancelled() else None)
+        return future
+
+    def withdraw(self, task):
+        "forget a cancelled task, it is removed from tasks/ if no worker claimed it yet"
+        with self.lock:
+            self.futures.pop(task, None)
+        try:
+            os.remove(os.path.join(self.spool, 'tasks', task + '.pkl'))
+        except FileNotFoundError:
+            pass    # already claimed, its result will be ignored
+
+    def map(self, population, **options):
+        "return the results of score_genotype(**options) in the same order as the population"
+        futures = [self.submit(modelcode, **options) for modelcode in population]
+        return [future.result() for future in futures]
+
+    def _poll(self):
+        while not self.closed.wait(POLL_INTERVAL):
+            self.collect()
+            self.requeue_lost()
+
+    def collect(self):
+        "resolve the futures of the results written by the workers"
+        results = os.path.join(self.spool, 'results')
+        for task in pickles(results):
+            with open(os.path.join(results, task + '.pkl'), 'rb') as f:
+                status, value = pickle.load(f)
+            os.remove(os.path.join(results, task + '.pkl'))
+            with self.lock:
+                # a reassigned task can be completed twice, only the first result is used
+                future = self.futures.pop(task, None)
+            if future is None or future.cancelled():
+                continue
+            if status == 'ok':
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(f"task {task} failed on the worker: {value}"))
+
+    def requeue_lost(self):
+        "move back to tasks/ the tasks claimed by workers without recent heartbeats"
+        running = os.path.join(self.spool, 'running')
+        for name in pickles(running):
+            task, worker = name.split('@')
+            if not self.is_lost(worker):
+                continue
+            try:
+                os.rename(os.path.join(running, name + '.pkl'), os.path.join(self.spool, 'tasks', task + '.pkl'))
+            except FileNotFoundError:
+                continue    # the worker finished it meanwhile
+            self.requeued += 1
+            print(f"Worker {worker} lost, task {task} reassigned")
+
+    def is_lost(self, worker):
+        # only the changes of the heartbeat are used, the clocks of the nodes do not need to agree
+        try:
+            mtime = os.stat(os.path.join(self.spool, 'workers', worker)).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        now = time.monotonic()
+        last = self.heartbeats.get(worker)
+        if last is None or last[0] != mtime:
+            self.heartbeats[worker] = (mtime, now)
+            return False
+        return now - last[1] > self.stale_after
+
+    def close(self, wait=True):
+        "stop the polling and ask the workers to exit; without wait the pending tasks are cancelled"
+        if wait:
+            while self.futures:
+                time.sleep(POLL_INTERVAL)
+        open(os.path.join(self.spool, 'stop'), 'w').close()
+        self.closed.set()
+        self.poller.join()
+        for future in list(self.futures.values()):
+            future.cancel()
+
+
+##############################################
+# WORKER
+##############################################
+
+def claim(spool, worker):
+    "move the oldest task to running/, return its name or None if there are no tasks"
+    for task in pickles(os.path.join(spool, 'tasks')):
+        try:
+            os.rename(os.path.join(spool, 'tasks', task + '.pkl'), os.path.join(spool, 'running', f"{task}@{worker}.pkl"))
+        except FileNotFoundError:
+            continue    # taken by another worker
+        return task
+    return None
+
+def heartbeat(path, stop):
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        with open(path, 'w') as f:
+            f.write(str(time.time()))
+
+def run_worker(spool, threads=1, worker=None):
+    '''
+    train the tasks of the spool directory until the coordinator closes it
+    threads: the number of torch threads of this worker
+    worker: the name of the worker, by default host and process id
+    '''
+    torch.set_num_threads(threads)
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    for d in SPOOL_DIRS:
+        os.makedirs(os.path.join(spool, d), exist_ok=True)
+
+    beat = os.path.join(spool, 'workers', worker)
+    open(beat, 'w').close()
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(beat, stop), daemon=True).start()
+
+    session, loaders = None, None
+    try:
+        while not os.path.exists(os.path.join(spool, 'stop')):
+            task = claim(spool, worker)
+            if task is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            running = os.path.join(spool, 'running', f"{task}@{worker}.pkl")
+            # the dataset is loaded again only when a new coordinator publishes a different configuration
+            if not task.startswith(f"{session}-"):
+                with open(os.path.join(spool, 'config.pkl'), 'rb') as f:
+                    config = pickle.load(f)
+                session = config['session']
+                trainloader, testloader, _, _, _ = config['dataset'](config['batch_size'])
+                loaders = (trainloader, testloader, config['batch_size'])
+
+            try:
+                with open(running, 'rb') as f:
+                    modelcode, options = pickle.load(f)
+                result = ('ok', score_genotype(modelcode, *loaders, **options))
+            except FileNotFoundError:
+                continue    # reassigned to another worker meanwhile
+            except Exception as e:
+                result = ('error', repr(e))
+            write_atomic(os.path.join(spool, 'results', task + '.pkl'), result)
+            try:
+                os.remove(running)
+            except FileNotFoundError:
+                pass        # reassigned meanwhile, the coordinator keeps the first result
+    finally:
+        stop.set()
+        if os.path.exists(beat):
+            os.remove(beat)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m src.broker SPOOL_DIR [--threads N]")
+        sys.exit(1)
+    threads = int(sys.argv[sys.argv.index('--threads') + 1]) if '--threads' in sys.argv else 1
+    run_worker(sys.argv[1], threads)
@@ -0,0 +1,150 @@
+from src.ga_level import *
+import struct
+
+'''
+
+This file contains a compact representation of Net_encoding, to keep a large number of genotypes in memory
+or on disk: a fixed-width numpy record for each module and for each layer, without the grammar and without
+the trained weights. The conversion to and from Net_encoding is lossless, and the binary format is versioned.
+
+'''
+
+COMPACT_VERSION = 1
+# magic, version, input shape, input channels, output channels, number of modules, number of layers
+HEADER = struct.Struct('<4sBIIIHH')
+MAGIC = b'GENO'
+
+# channels which are not known yet, before Net_encoding.setting_channels
+UNDEFINED = -1
+
+MODULE_DTYPE = np.dtype([('type', 'u1'), ('c_in', '<i4'), ('c_out', '<i4'), ('layers', '<u2')])
+# the fields which do not apply to the type of the layer are 0
+LAYER_DTYPE = np.dtype([('type', 'u1'), ('kernel', 'u1'), ('stride', 'u1'), ('padding', 'u1'), ('pool', 'u1'),
+                        ('activation', 'u1'), ('bias', '?'), ('c_in', '<i4'), ('c_out', '<i4'),
+                        ('eps', '<f8'), ('momentum', '<f8')])
+
+PADDINGS = list(padding_type)
+
+
+class CompactGenotype:
+    "Net_encoding as two record arrays, the modules in the order of GA_encoding and all their layers in sequence."
+    __slots__ = ('input_shape', 'input_channels', 'output_channels', 'modules', 'layers')
+
+    def __init__(self, input_shape, input_channels, output_channels, modules, layers):
+        self.input_shape = input_shape
+        self.input_channels = input_channels
+        self.output_channels = output_channels
+        self.modules = modules
+        self.layers = layers
+
+    @property
+    def nbytes(self):
+        return HEADER.size + self.modules.nbytes + self.layers.nbytes
+
+    def to_encoding(self):
+        "the Net_encoding, built without drawing random numbers"
+        netcode = Net_encoding.__new__(Net_encoding)
+        netcode.input_shape = self.input_shape
+        netcode.input_channels = self.input_channels
+        netcode.param = {'input_channels': self.input_channels, 'output_channels': self.output_channels}
+        netcode.features, netcode.classification, netcode.last_layer = [], [], []
+        groups = {module_types.FEATURES: netcode.features, module_types.CLASSIFICATION: netcode.classification,
+                  module_types.LAST_LAYER: netcode.last_layer}
+
+        start = 0
+        for record in self.modules:
+            module = Module.__new__(Module)
+            module.M_type = module_types(int(record['type']))
+            module.layers = [expand_layer(r) for r in self.layers[start:start + record['layers']]]
+            module.weights = None
+            module.grammar = g.load(PATH)
+            module.param = {'input_channels': channels(record['c_in']), 'output_channels': channels(record['c_out'])}
+            groups[module.M_type].append(module)
+            start += int(record['layers'])
+        return netcode
+
+    def to_bytes(self):
+        "the versioned binary serialization"
+        header = HEADER.pack(MAGIC, COMPACT_VERSION, self.input_shape, self.input_channels, self.output_channels,
+                             len(self.modules), len(self.layers))
+        return header + self.modules.tobytes() + self.layers.tobytes()
+
+
+def compact(netcode):
+    "the CompactGenotype of a Net_encoding, its stored weights are left out"
+    modules = netcode.modules()
+    module_records = np.zeros(len(modules), dtype=MODULE_DTYPE)
+    layer_records = np.zeros(sum(m.len() for m in modules), dtype=LAYER_DTYPE)
+    k = 0
+    for record, module in zip(module_records, modules):
+        record['type'] = module.M_type.value
+        record['c_in'] = compact_channels(module.param['input_channels'])
+        record['c_out'] = compact_channels(module.param['output_channels'])
+        record['layers'] = module.len()
+        for layer in module.layers:
+            compact_layer(layer, layer_records[k:k + 1])
+            k += 1
+    return CompactGenotype(int(netcode.input_shape), int(netcode.input_channels), int(netcode.param['output_channels']),
+                           module_records, layer_records)
+
+
+def from_bytes(data):
+    "the CompactGenotype written by CompactGenotype.to_bytes"
+    magic, version, input_shape, input_channels, output_channels, n_modules, n_layers = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not a compact genotype")
+    if version != COMPACT_VERSION:
+        raise ValueError(f"compact genotype has version {version}, expected {COMPACT_VERSION}")
+    offset = HEADER.size
+    modules = np.frombuffer(data, dtype=MODULE_DTYPE, count=n_modules, offset=offset).copy()
+    offset += modules.nbytes
+    layers = np.frombuffer(data, dtype=LAYER_DTYPE, count=n_layers, offset=offset).copy()
+    return CompactGenotype(input_shape, input_channels, output_channels, modules, layers)
+
+
+def compact_channels(c):
+    return c if isinstance(c, (int, np.integer)) else UNDEFINED
+
+def channels(c):
+    return int(c) if c != UNDEFINED else "not already defined"
+
+
+def compact_layer(layer, record):
+    "fill the record (a slice of one element) with the type, the parameters and the channels of the layer"
+    record['type'] = layer.type.value
+    record['c_in'] = compact_channels(layer.channels['in'])
+    record['c_out'] = compact_channels(layer.channels['out'])
+    if layer.type == layer_type.CONV:
+        record['kernel'] = layer.param['kernel_size']
+        record['stride'] = layer.param['stride']
+        record['padding'] = PADDINGS.index(padding_type(layer.param['padding']))
+        record['bias'] = layer.param['bias']
+    elif layer.type == layer_type.POOLING:
+        record['kernel'] = layer.param['kernel_size']
+        record['stride'] = layer.param['stride']
+        record['padding'] = layer.param['padding']
+        record['pool'] = layer.param['pool_type'].value
+    elif layer.type == layer_type.ACTIVATION:
+        record['activation'] = layer.param.value
+    elif layer.type == layer_type.BATCH_NORM:
+        record['eps'] = layer.param['eps']
+        record['momentum'] = layer.param['momentum']
+
+def expand_layer(record):
+    "the Layer of a record, built without drawing random numbers"
+    layer = Layer.__new__(Layer)
+    layer.type = layer_type(int(record['type']))
+    layer.channels = {'in': channels(record['c_in']), 'out': channels(record['c_out'])}
+    if layer.type == layer_type.CONV:
+        layer.param = {'kernel_size': int(record['kernel']), 'stride': int(record['stride']),
+                       'padding': PADDINGS[record['padding']].value, 'bias': bool(record['bias'])}
+    elif layer.type == layer_type.POOLING:
+        layer.param = {'pool_type': pool(int(record['pool'])), 'kernel_size': int(record['kernel']),
+                       'stride': int(record['stride']), 'padding': int(record['padding'])}
+    elif layer.type == layer_type.ACTIVATION:
+        layer.param = activation(int(record['activation']))
+    elif layer.type == layer_type.BATCH_NORM:
+        layer.param = {'eps': float(record['eps']), 'momentum': float(record['momentum'])}
+    else:
+        layer.param = None
+    return layer
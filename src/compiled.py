@@ -0,0 +1,58 @@
+from src.nn_encoding import *
+from collections import OrderedDict
+
+'''
+
+This file contains a per-process cache of compiled networks: a network is compiled once for each
+architecture and, once its training is over, it is reused with new random weights by the next genotype
+with the same signature (elites, duplicates, offspring equal to their parents).
+
+'''
+
+# compilers of the layers of a Net: TorchScript or torch.compile (inductor, it needs a C++ compiler on the CPU)
+BACKENDS = ('script', 'compile')
+# number of architectures kept by each process, the least recently used is dropped
+MAX_COMPILED = 32
+
+# genotype hash -> networks already compiled and not in use
+_compiled = OrderedDict()
+compile_stats = {'compiled': 0, 'reused': 0}
+
+
+def compile_net(model, backend='script'):
+    "compile the layers of the network in place, the parameters are shared with model.layer_list"
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown compile backend {backend}, expected one of {BACKENDS}")
+    if backend == 'script':
+        model.layers = torch.jit.script(model.layers)
+    else:
+        model.layers.compile()
+    return model
+
+
+def acquire_net(netcode, backend='script'):
+    "a compiled Net of the genotype with random weights, built only if no free network has the same architecture"
+    netcode.update_encoding()
+    netcode.setting_channels()
+    free = _compiled.get(netcode.genotype_hash())
+    if free:
+        model = free.pop()
+        model.rebind(netcode)
+        model.reset_parameters()
+        compile_stats['reused'] += 1
+        return model
+
+    compile_stats['compiled'] += 1
+    return compile_net(Net(netcode), backend)
+
+
+def release_net(model):
+    "give back a network obtained from acquire_net, it must not be used afterwards"
+    key = model.Net_encoding.genotype_hash()
+    # the encoding may carry stored weights, the cache must not keep it alive
+    model.Net_encoding, model.origin = None, None
+    model.training_log = None
+    _compiled.setdefault(key, []).append(model)
+    _compiled.move_to_end(key)
+    while len(_compiled) > MAX_COMPILED:
+        _compiled.popitem(last=False)
@@ -40,6 +40,9 @@ MAX_CHANNEL_FEATURES = 50
 MIN_CHANNEL_CLASSIFICATION = 64
 MAX_CHANNEL_CLASSIFICATION = 2048
 
+# networks with a larger input to the first linear layer are rejected before being built
+MAX_FLATTEN = 65536
+
 
             
 #####################
@@ -149,6 +152,33 @@ class Layer:
     def get(self):  #return the gene
         return self.type, self.param, self.channels
 
+    def with_channels(self, c_in, c_out):
+        "the layer with the given channels, copied only if they change: a layer can be shared by several modules"
+        if self.channels['in'] == c_in and self.channels['out'] == c_out:
+            return self
+        layer = copy.copy(self)
+        layer.channels = {'in': c_in, 'out': c_out}
+        return layer
+
+    def signature(self):
+        "canonical description of the gene, input channels and derived output channels are left out"
+        if isinstance(self.param, dict):
+            param = tuple(sorted((k, canonical_value(v)) for k, v in self.param.items()))
+        else:
+            param = canonical_value(self.param)
+
+        c_out = canonical_value(self.channels['out']) if self.type in (layer_type.CONV, layer_type.LINEAR) else None
+        return (self.type.name, param, c_out)
+
+
+def canonical_value(v):
+    "enums by name and numpy scalars as python numbers, so that equal genes always print the same"
+    if isinstance(v, Enum):
+        return v.name
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
 
 #####################
 # Modules definition #
@@ -168,8 +198,11 @@ class Module:
         self.M_type = M_type #set the type
         self.layers = []
         c_in = "not already defined"
+        # trained weights of the layers, index of the layer -> state_dict, see Net.export_weights
+        self.weights = None
 
-        self.grammar = g.Grammar(PATH)
+        # the grammar is read once per process and shared, see grammar.load
+        self.grammar = g.load(PATH)
 
         if self.M_type == module_types.CLASSIFICATION:
             tmp_cout = np.random.randint(MIN_CHANNEL_CLASSIFICATION, MAX_CHANNEL_CLASSIFICATION) 
@@ -297,6 +330,39 @@ class Module:
     def get(self):
         return self.M_type, self.layers
 
+    def signature(self):
+        return (self.M_type.name, tuple(l.signature() for l in self.layers))
+
+    def without_weights(self):
+        "shallow copy of the module without the trained weights, e.g. to be saved on disk"
+        return self.with_weights(None)
+
+    # a module can be shared by several encodings (parents and offspring), it is never changed in place:
+    # the methods below return a copy which shares the unchanged layers
+
+    def with_weights(self, weights):
+        "the module with other trained weights"
+        module = copy.copy(self)
+        module.weights = weights
+        return module
+
+    def with_layer(self, j, layer):
+        "the module with the j-th layer replaced"
+        module = copy.copy(self)
+        module.layers = self.layers[:j] + [layer] + self.layers[j + 1:]
+        return module
+
+    def with_channels(self, channels):
+        "the module with the (in, out) channels of each layer, itself if they do not change"
+        layers = [l.with_channels(c_in, c_out) for l, (c_in, c_out) in zip(self.layers, channels)]
+        param = {'input_channels': channels[0][0], 'output_channels': channels[-1][1]}
+        if param == self.param and all(new is old for new, old in zip(layers, self.layers)):
+            return self
+        module = copy.copy(self)
+        module.layers = layers
+        module.param = param
+        return module
+
     def print(self, index=None): #print the GA_encoding
         print(f"\n module: {index}")
         print(f"{self.M_type}")
@@ -0,0 +1,162 @@
+from src.nn_encoding import *
+from src.compiled import acquire_net, release_net
+from scripts.train import train, eval, train_many, eval_many, evaluate, bf16_supported, EVAL_BATCH_SIZE
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import multiprocessing as mp
+import time
+
+'''
+
+This file contains the functions used to compute the fitness of a genotype,
+either in the current process or in a pool of worker processes.
+
+'''
+
+
+# fitness of a network whose training was aborted by the early stopping policy
+ABORTED_SCORE = 0
+# fraction of the training set seen by each network, the default fidelity
+TRAIN_FRACTION = 0.1
+# fraction of the training set used to fine-tune a network which inherited weights from its parents
+FINETUNE_FRACTION = 0.03
+# number of networks trained by benchmark_cpu_perf, twice each
+BENCHMARK_NETWORKS = 3
+
+
+def score_genotype(modelcode, trainloader, testloader, batch_size, early_stop=None, fraction=TRAIN_FRACTION,
+                   inherit=False, finetune_fraction=FINETUNE_FRACTION, eval_batch_size=EVAL_BATCH_SIZE,
+                   cpu_perf=False, compile=None):
+    """
+    build the network of the genotype, train it and return its accuracy on the testloader
+    together with the training log (smoothed final loss, reason of the early stop)
+    inherit: start from the weights stored in the modules by the training of the parents, if any, and only
+             fine-tune on finetune_fraction of the training set; the new weights are returned in the log
+    eval_batch_size: the minibatch size of the inference on the testloader
+    cpu_perf: train and evaluate in the CPU performance mode of scripts.train
+    compile: None to run the network in eager mode, otherwise the backend of src.compiled ('script', 'compile');
+             the compiled network is reused by the next genotype with the same architecture
+    """
+    model = acquire_net(modelcode, compile) if compile else Net(modelcode)
+    inherited = model.inherit_weights() if inherit else 0
+    if inherited:
+        fraction = min(fraction, finetune_fraction)
+
+    model = train(model, trainloader, batch_size, early_stop=early_stop, fraction=fraction, cpu_perf=cpu_perf)
+    model.training_log['inherited'] = inherited
+    if inherit:
+        model.training_log['weights'] = model.export_weights()
+
+    log = model.training_log
+    if log['stopped'] is not None:
+        print("Training aborted,", log['stopped'])
+        score = ABORTED_SCORE
+    else:
+        score = eval(model, testloader, eval_batch_size, cpu_perf)
+    if compile:
+        release_net(model)
+    return score, log
+
+
+def score_genotypes_fused(population, trainloader, testloader, batch_size, group_size, early_stop=None, fraction=TRAIN_FRACTION,
+                          inherit=False, finetune_fraction=FINETUNE_FRACTION, eval_batch_size=EVAL_BATCH_SIZE,
+                          cpu_perf=False, compile=None):
+    "like score_genotype on each genotype, but group_size networks at a time share the minibatches"
+    results = []
+    for start in range(0, len(population), group_size):
+        models = [acquire_net(modelcode, compile) if compile else Net(modelcode) for modelcode in population[start:start + group_size]]
+        inherited = [model.inherit_weights() if inherit else 0 for model in models]
+        # the networks which inherited weights are only fine-tuned, they leave the group earlier
+        fractions = [min(fraction, finetune_fraction) if n else fraction for n in inherited]
+        models = train_many(models, trainloader, batch_size, early_stop=early_stop, fraction=fractions, cpu_perf=cpu_perf)
+        for model, n in zip(models, inherited):
+            model.training_log['inherited'] = n
+            if inherit:
+                model.training_log['weights'] = model.export_weights()
+
+        finished = [model for model in models if model.training_log['stopped'] is None]
+        accuracies = iter(eval_many(finished, testloader, eval_batch_size, cpu_perf) if finished else [])
+        for model in models:
+            log = model.training_log
+            if log['stopped'] is not None:
+                print("Training aborted,", log['stopped'])
+                results.append((ABORTED_SCORE, log))
+            else:
+                results.append((next(accuracies), log))
+        if compile:
+            for model in models:
+                release_net(model)
+    return results
+
+
+def benchmark_cpu_perf(population, trainloader, testloader, batch_size, fraction=TRAIN_FRACTION, eval_batch_size=EVAL_BATCH_SIZE,
+                       sample=BENCHMARK_NETWORKS):
+    """
+    train the first sample genotypes twice from the same initialization and on the same minibatches, with and
+    without the CPU performance mode, and return the speedup of the training and the mean accuracy delta (perf - base)
+    the random state of torch is restored, the rest of the run does not depend on the benchmark
+    """
+    population = population[:sample]
+    times = {False: 0.0, True: 0.0}
+    accuracies = {False: [], True: []}
+    with torch.random.fork_rng():
+        for i, modelcode in enumerate(population):
+            model = Net(modelcode)
+            initial = copy.deepcopy(model.state_dict())
+            # alternate the first mode, the first training also pays the one-off setup of the kernels
+            for cpu_perf in ((False, True) if i % 2 == 0 else (True, False)):
+                model.load_state_dict(initial)
+                torch.manual_seed(i)
+                start = time.perf_counter()
+                train(model, trainloader, batch_size, fraction=fraction, cpu_perf=cpu_perf)
+                times[cpu_perf] += time.perf_counter() - start
+                accuracies[cpu_perf].append(evaluate(model, testloader, eval_batch_size, cpu_perf)['accuracy'])
+
+    return {'networks': len(population), 'bf16': bf16_supported(),
+            'base_time': times[False], 'perf_time': times[True], 'speedup': times[False] / times[True],
+            'accuracy_delta': float(np.mean(accuracies[True]) - np.mean(accuracies[False]))}
+
+
+##############################################
+# PROCESS POOL
+##############################################
+
+# state of a worker process, filled once by _init_worker
+_worker = {}
+
+def _init_worker(dataset, batch_size, threads):
+    # small nets do not scale with intra-op threads, each worker gets only a few of them
+    torch.set_num_threads(threads)
+    trainloader, testloader, _, _, _ = dataset(batch_size)
+    _worker['trainloader'] = trainloader
+    _worker['testloader'] = testloader
+    _worker['batch_size'] = batch_size
+
+def _score_in_worker(modelcode, options):
+    return score_genotype(modelcode, _worker['trainloader'], _worker['testloader'], _worker['batch_size'], **options)
+
+
+class PoolEvaluator:
+    "Score genotypes on a pool of worker processes, each one with its own copy of the dataset."
+    def __init__(self, dataset, batch_size, workers, threads_per_worker=1):
+        '''
+        dataset: the dataset function (MNIST, cifar10), it must give the same split in every process
+        batch_size: the batch size used to construct the trainloader and testloader
+        workers: the number of worker processes
+        threads_per_worker: the number of torch threads of each worker
+        '''
+        self.workers = workers
+        # spawn instead of fork: forking a process which already started the torch thread pool can deadlock
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'),
+                                            initializer=_init_worker, initargs=(dataset, batch_size, threads_per_worker))
+
+    def map(self, population, **options):
+        "return the results of score_genotype(**options) in the same order as the population"
+        return list(self.executor.map(_score_in_worker, population, repeat(options)))
+
+    def submit(self, modelcode, **options):
+        return self.executor.submit(_score_in_worker, modelcode, options)
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
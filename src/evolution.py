@@ -1,14 +1,65 @@
 from src.nn_encoding import *
-from scripts.train import train, eval, test_model
+from scripts.train import train, eval, test_model, measure_latency, bf16_supported, EVAL_BATCH_SIZE
+from src.evaluation import score_genotype, score_genotypes_fused, PoolEvaluator, TRAIN_FRACTION, ABORTED_SCORE
+from src.ledger import FitnessLedger
+from src.broker import SpoolEvaluator
+from scripts.proxies import proxy_batch, compute_proxy
+from src.surrogate import featurize, RidgeSurrogate, MIN_SAMPLES
+from src.pareto import nsga2_order, ParetoArchive
+
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+import pickle
+import signal
 
 MUTATION_RATE = 30
 CROSSOVER_RATE = 70
+# an offspring whose encoding can not be repaired is bred again at most this number of times
+MAX_BREED_ATTEMPTS = 10
+
+# default successive halving: fractions of the training set of each rung, the last one is the full budget
+HALVING_BUDGETS = (0.01, 0.03, TRAIN_FRACTION)
+HALVING_ETA = 3
+# number of individuals drawn by each tournament of the steady state evolution
+TOURNAMENT_SIZE = 3
+
+# format of the checkpoints, and the attributes of evolution they contain besides the random states
+CHECKPOINT_VERSION = 1
+CHECKPOINT_ATTRIBUTES = ('population', 'scores', 'best_organism', 'best_score', 'fitness_cache', 'cache_hits', 'ledger_hits',
+                         'aborted', 'loss_reference', 'rung_scores', 'screened_out', 'surrogate_data', 'latencies', 'rejected')
 
 class evolution():
-    def __init__(self, population_size=10, holdout=1, mating=True, dataset=None, batch_size=4):
+    def __init__(self, population_size=10, holdout=1, mating=True, dataset=None, batch_size=4, cache=True, workers=1, threads_per_worker=1, ledger=None, fuse=1, early_stop=None, halving=None, eta=HALVING_ETA, inherit_weights=False, prescreen=None, prescreen_percentile=25, surrogate_pool=1,
+                 selection='accuracy', cost_objective='params', archive=None, eval_batch_size=EVAL_BATCH_SIZE,
+                 cpu_perf=False, compile=None, resume=None, broker=None):
         """
         initial function fun is a function to produce nets, used for the original population
         scoring_function must be a function which accepts a net as input and returns a float
+        cache: if True the score of each genotype is stored and never recomputed
+        workers: if greater than 1 the population is trained on a pool of worker processes
+        threads_per_worker: the number of torch threads of each worker process
+        ledger: path of a SQLite file where the scores are shared with other runs on the same dataset
+        fuse: without workers, how many networks are trained together on the same minibatches
+        early_stop: a policy of scripts.early_stopping, the networks it aborts get ABORTED_SCORE
+        halving: increasing training budgets (fractions of the training set), all the networks are trained
+                 with the first one and only the best 1/eta of each budget is promoted to the next one
+        inherit_weights: the offspring start from the trained weights of the modules they share with
+                         their parents and are only fine-tuned (Lamarckian evolution)
+        prescreen: name of a proxy of scripts.proxies (naswot, synflow, grad_norm) computed before the training,
+                   the new individuals below prescreen_percentile of the proxy are not trained and get ABORTED_SCORE
+        surrogate_pool: if greater than 1, surrogate_pool times more offspring are bred in each generation and
+                        a ridge regression fitted on all the scored genotypes keeps the most promising ones
+        selection: 'accuracy' sorts the population on the score, 'nsga2' on the Pareto fronts of the score
+                   and of the cost_objective ('params', 'macs' or 'latency' in milliseconds on the CPU)
+        archive: pickle file where the Pareto front of all the generations is kept, with selection 'nsga2'; it is read back only with resume
+        eval_batch_size: the minibatch size of the inference on the test set, independent of batch_size
+        cpu_perf: train and evaluate with channels last tensors, bfloat16 autocast and fused optimizer steps
+        compile: compile the networks with TorchScript ('script') or torch.compile ('compile'), each process
+                 keeps the compiled networks and reuses them for the genotypes with the same architecture
+        resume: checkpoint written by save_checkpoint, if it exists the evolution restarts from it instead of
+                scoring a new random population; the extra values saved with it are in self.resumed
+        broker: spool directory of src.broker, the population is trained by the workers started on it
+                (python -m src.broker DIR) on any node, instead of by this process or its pool;
+                workers is then the number of trainings kept in flight by steady_state
         """
         try:
             trainloader, testloader, input_size, n_classes, input_channels = dataset(batch_size)
@@ -22,70 +73,545 @@ class evolution():
         self.testloader = testloader
         print(self.trainloader)
         self.batch_size = batch_size
+        self.eval_batch_size = eval_batch_size
+        self.cpu_perf = cpu_perf
+        self.compile = compile
         
 
         self.population_size = population_size
         self.population = []
         self.scores = []
 
-        for _ in range(self.population_size):
+        # fidelity -> genotype hash -> score, elites and unchanged offspring are not trained again
+        self.cache = cache
+        self.fitness_cache = {}
+        self.cache_hits = 0
+
+        self.early_stop = early_stop
+        self.inherit_weights = inherit_weights
+        self.ledger = None
+        self.ledger_hits = 0
+        if ledger is not None:
+            # dataset can be a functools.partial of MNIST or cifar10, e.g. with preload=True
+            self.ledger = FitnessLedger(ledger, getattr(dataset, 'func', dataset).__name__, self.fidelity(TRAIN_FRACTION))
+
+        self.fuse = fuse
+
+        # genotype hash -> reason of the abort; fidelity -> median final loss, the reference of CurveStop
+        self.aborted = {}
+        self.loss_reference = {}
+
+        # for each call of get_best_organism, the scores of every rung: a list of {individual: score}, where
+        # individual is the index in the sorted population, as in population_stats
+        self.halving = halving
+        self.eta = eta
+        self.rung_scores = []
+
+        self.prescreen = prescreen
+        self.prescreen_percentile = prescreen_percentile
+        self.screened_out = 0
+
+        # genotype hash -> (features, score) of every genotype scored with the full budget
+        self.surrogate_pool = surrogate_pool
+        self.surrogate = RidgeSurrogate()
+        self.surrogate_data = {}
+
+        self.selection = selection
+        self.cost_objective = cost_objective
+        self.input_shape = input_size
+        self.input_channels = input_channels
+        self.latencies = {}     # genotype hash -> milliseconds, measured once
+        resuming = resume is not None and os.path.exists(resume)
+        self.archive = ParetoArchive(archive, cost_objective, resuming) if selection == 'nsga2' else None
+
+        # trainings submitted by steady_state and not arrived yet: future -> (genotype hash, offspring)
+        self.slots = workers
+        self.in_flight = {}
+
+        self.evaluator = None
+        if broker is not None:
+            self.evaluator = SpoolEvaluator(broker, dataset, batch_size)
+        elif workers > 1:
+            self.evaluator = PoolEvaluator(dataset, batch_size, workers, threads_per_worker)
+
+        # offspring rejected by the static shape analysis, before building any network
+        self.rejected = 0
+        # offspring bred in the last generation and how many of them were already in the population, they are bred again
+        self.bred = 0
+        self.duplicates = 0
+
+        self.holdout = max(1, int(holdout * population_size))
+        self.mating = mating
+
+        self.resumed = None
+        if resuming:
+            self.resumed = self.load_checkpoint(resume)
+            return
+
+        present = set()
+        while len(self.population) < self.population_size:
             num_feat = np.random.randint(1, MAX_LEN_FEATURES)
             num_class = np.random.randint(1, MAX_LEN_CLASSIFICATION)
-            self.population.append(Net_encoding(num_feat, num_class, input_channels, n_classes, input_size))
+            netcode = Net_encoding(num_feat, num_class, input_channels, n_classes, input_size)
+            valid, reason = netcode.repair()
+            if valid and netcode.genotype_hash() in present:
+                self.duplicates += 1
+            elif valid:
+                present.add(netcode.genotype_hash())
+                self.population.append(netcode)
+            else:
+                self.rejected += 1
+                print("Network rejected,", reason)
 
         self.get_best_organism()
-        self.holdout = max(1, int(holdout * population_size))
-
-        self.mating = mating
         
         
 
+    def population_stats(self):
+        "statistics for each individual of the current population"
+        return [{"individual": i, "score": self.scores[i], "len": self.population[i]._len(), "genotype": self.population[i],
+                 "cost": self.population[i].cost(self.batch_size)} for i in range(self.population_size)]
+
     def generation(self):
         # statistics for each individual
-        generation = [{"individual": i, "score": self.scores[i], "len": self.population[i]._len(), "genotype": self.population[i]} for i in range(self.population_size)]
+        generation = self.population_stats()
 
         # create new population 
         new_population = [self.best_organism] # Ensure best organism survives
+        self.bred, self.duplicates = 0, 0
+        present = {self.best_organism.genotype_hash()}
+
+        if self.surrogate_pool > 1 and len(self.surrogate_data) >= MIN_SAMPLES:
+            new_population.extend(self.surrogate_selection(self.population_size - 1, present))
+        else:
+            new_population.extend(self.breed_distinct(i, present) for i in range(self.population_size - 1))
+        
+        self.population = new_population
+
+        return generation
+
+    def breed(self, i, parents=None):
+        '''
+        the i-th offspring of the current population, bred again if its encoding can not be repaired
+        parents: the two parents, instead of the ones chosen by rank
+        the individuals of the population are never changed, the offspring is always a new encoding
+        '''
+        for _ in range(MAX_BREED_ATTEMPTS):
+            offspring = self.mate(i, parents)
+            valid, reason = offspring.repair()
+            if valid:
+                return offspring
+            self.rejected += 1
+            print("Offspring rejected,", reason)
+        return self.best_organism.clone()
 
-        for i in range(self.population_size - 1):
+    def breed_distinct(self, i, present, parents=None):
+        '''
+        breed, again while the genotype of the offspring is in present (a set of genotype hashes), so that
+        the population is not filled with copies which would be mutated and scored more than once;
+        after MAX_BREED_ATTEMPTS the duplicate is kept. The hash of the offspring is added to present
+        '''
+        for _ in range(MAX_BREED_ATTEMPTS):
+            offspring = self.breed(i, parents)
+            key = offspring.genotype_hash()
+            self.bred += 1
+            if key not in present:
+                break
+            self.duplicates += 1
+        present.add(key)
+        return offspring
+
+    def duplicate_rate(self):
+        "fraction of the offspring of the last generation which were already in the population"
+        return self.duplicates / self.bred if self.bred else 0.0
+
+    def mate(self, i, parents=None):
+        "crossover and mutation of the parents of the i-th offspring, or of the given pair of parents"
+        if parents is None:
             parent_1_idx = i % self.holdout
             if self.mating:
                 parent_2_idx = min(self.population_size - 1, int(np.random.exponential(self.holdout)))
             else:
                 parent_2_idx = parent_1_idx
+            parents = (self.population[parent_1_idx], self.population[parent_2_idx])
+        parent_1, parent_2 = parents
 
-            if np.random.randint(100) < CROSSOVER_RATE:
-                child1, child2 = GA_crossover(self.population[parent_1_idx], self.population[parent_2_idx])
-                offspring = child1 if child1._len() < child2._len() else child2
-            else:
-                offspring = self.population[parent_1_idx]
-    
-            if np.random.randint(0, 100) < MUTATION_RATE:
-                GA_mutation(offspring)
-            if np.random.randint(0, 100) < MUTATION_RATE:
-                dsge_mutation(offspring)
-            new_population.append(offspring)
-        
-        self.population = new_population
+        if np.random.randint(100) < CROSSOVER_RATE:
+            child1, child2 = GA_crossover(parent_1, parent_2)
+            offspring, other = (child1, child2) if child1._len() < child2._len() else (child2, child1)
+            # the other child is taken only if it is valid and the preferred one is not
+            if not offspring.repair()[0] and other.repair()[0]:
+                offspring = other
+        else:
+            # copy on write: the parent stays in the population as it is
+            offspring = parent_1.clone()
 
-        return generation
+        if np.random.randint(0, 100) < MUTATION_RATE:
+            GA_mutation(offspring)
+        if np.random.randint(0, 100) < MUTATION_RATE:
+            dsge_mutation(offspring)
+        return offspring
+
+    def surrogate_selection(self, n, present):
+        "breed surrogate_pool * n distinct offspring and keep the n with the best predicted score"
+        X, y = zip(*self.surrogate_data.values())
+        self.surrogate.fit(np.stack(X), y)
+
+        seen = set(present)
+        candidates = {}
+        for i in range(n * self.surrogate_pool):
+            offspring = self.breed_distinct(i, seen)
+            # a duplicate kept after too many attempts is not a candidate twice
+            candidates.setdefault(offspring.genotype_hash(), offspring)
+        candidates = list(candidates.values())
+
+        predicted = self.surrogate.predict(np.stack([featurize(x) for x in candidates]))
+        chosen = [candidates[j] for j in np.argsort(predicted, kind='stable')[::-1][:n]]
+        present.update(x.genotype_hash() for x in chosen)
+        # not enough distinct candidates, the population is filled as usual
+        chosen.extend(self.breed_distinct(i, present) for i in range(n - len(chosen)))
+        return chosen
+
+    def steady_state(self, arrivals, tournament_size=TOURNAMENT_SIZE):
+        '''
+        Asynchronous evolution without generations: whenever one of the self.slots trainings is over, an offspring
+        of two parents chosen by tournament is submitted, and each offspring replaces the worst individual as soon
+        as its score arrives. The trainings still running when it returns are kept for the next call.
+        arrivals: the number of offspring scored before returning, a few more if several trainings end together
+        return: the (offspring, score) pairs in order of arrival
+        Successive halving, the prescreen and the surrogate are not used, every offspring gets the full budget.
+        '''
+        fidelity = self.fidelity(TRAIN_FRACTION)
+        options = self.training_options(TRAIN_FRACTION)
+        arrived = []
+        results = []
+        self.bred, self.duplicates = 0, 0
+        while len(arrived) < arrivals:
+            # keep every slot busy, offspring already scored arrive at once
+            while len(self.in_flight) < self.slots and len(arrived) < arrivals:
+                parents = (self.population[self.tournament(tournament_size)], self.population[self.tournament(tournament_size)])
+                # the genotypes in the population or already in training are not bred again
+                present = {x.genotype_hash() for x in self.population} | {key for key, _ in self.in_flight.values()}
+                offspring = self.breed_distinct(len(arrived), present, parents)
+                key = offspring.genotype_hash()
+                score = self.known_score(key, fidelity)
+                if score is not None:
+                    self.record_score(key, offspring, score, None, fidelity, trained=False)
+                    arrived.append(self.replace_worst(offspring, score))
+                    continue
+                self.set_loss_reference(results, fidelity)
+                self.in_flight[self.submit(offspring, options)] = (key, offspring)
+
+            if not self.in_flight:
+                continue
+            done, _ = wait(self.in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, offspring = self.in_flight.pop(future)
+                score, log = future.result()
+                results.append((score, log))
+                self.record_score(key, offspring, score, log, fidelity)
+                arrived.append(self.replace_worst(offspring, score))
+
+        self.loss_reference[fidelity] = self.median_loss(results, self.loss_reference.get(fidelity))
+        order = np.argsort(self.scores, kind='stable')[::-1]
+        self.population = [self.population[x] for x in order]
+        self.scores = [self.scores[x] for x in order]
+        return arrived
+
+    def tournament(self, size):
+        "index of the best of size individuals drawn at random from the population"
+        drawn = np.random.choice(len(self.population), min(size, len(self.population)), replace=False)
+        return int(drawn[np.argmax([self.scores[i] for i in drawn])])
+
+    def replace_worst(self, offspring, score):
+        "put the offspring in the place of the worst individual, the best organism is updated"
+        worst = int(np.argmin(self.scores))
+        self.population[worst] = offspring
+        self.scores[worst] = score
+        if score > self.best_score:
+            self.best_organism = offspring
+            self.best_score = score
+        return offspring, score
+
+    def submit(self, modelcode, options):
+        "the Future of score_genotype on the evaluator, or already done if there is none"
+        if self.evaluator is not None:
+            return self.evaluator.submit(modelcode, **options)
+        future = Future()
+        future.set_result(score_genotype(modelcode, self.trainloader, self.testloader, self.batch_size, **options))
+        return future
+
+    def known_score(self, key, fidelity):
+        "the score of the genotype from the cache or from the ledger, None if it was never trained with this fidelity"
+        cache = self.fitness_cache.get(fidelity, {})
+        if self.cache and key in cache:
+            self.cache_hits += 1
+            return cache[key]
+        if self.ledger is not None:
+            score = self.ledger.get(key, fidelity)
+            if score is not None:
+                self.ledger_hits += 1
+                return score
+        return None
+
+    def record_score(self, key, x, score, log, fidelity, trained=True):
+        "what evaluate does with the score of each genotype, for a single genotype"
+        if log is not None and log['stopped'] is not None:
+            self.aborted[key] = log['stopped']
+        if log is not None and 'weights' in log:
+            x.set_weights(log.pop('weights'))
+        if trained and self.ledger is not None:
+            self.ledger.put(key, score, fidelity)
+        if key not in self.surrogate_data:
+            self.surrogate_data[key] = (featurize(x), score)
+        if self.cache:
+            self.fitness_cache.setdefault(fidelity, {})[key] = score
 
     def get_best_organism(self):   
-        self.scores = [self.scoring_function(x) for x in self.population]
-        self.population = [self.population[x] for x in np.argsort(self.scores)[::-1]]
-        
-        self.best_organism = copy.deepcopy(self.population[0])
-        self.best_score = sorted(self.scores)[-1]
+        keep = self.prescreen_population(self.population) if self.prescreen else [True] * len(self.population)
+        kept = [x for x, k in zip(self.population, keep) if k]
+
+        if self.halving:
+            kept_scores = self.successive_halving(kept)
+            # the individuals not promoted to the last rung only have the score of a lower budget
+            kept_final = [j in self.rung_scores[-1][-1] for j in range(len(kept))]
+        else:
+            kept_scores = self.evaluate(kept)
+            kept_final = [True] * len(kept)
+        scored = iter(zip(kept_scores, kept_final))
+        scored = [next(scored) if k else (ABORTED_SCORE, False) for k in keep]
+        self.scores = [score for score, _ in scored]
+
+        if self.selection == 'nsga2':
+            costs = [self.cost_of(x) for x in self.population]
+            # the screened out and aborted networks have no real accuracy, a low cost must not put them on a front
+            trained = [score != ABORTED_SCORE for score in self.scores]
+            order = nsga2_order([(-score, cost) for score, cost in zip(self.scores, costs)], trained)
+            self.archive.update([(x.genotype_hash(), x, score, cost) for x, (score, final), cost, real
+                                 in zip(self.population, scored, costs, trained) if final and real])
+        else:
+            order = np.argsort(self.scores)[::-1]
+        # scores are kept in the same order of the population, generation() pairs them by index
+        self.population = [self.population[x] for x in order]
+        self.scores = [self.scores[x] for x in order]
+        if self.halving:
+            # the rungs refer to the kept individuals, they are mapped to the sorted population like population_stats
+            kept_index = [i for i, k in enumerate(keep) if k]
+            position = {int(x): rank for rank, x in enumerate(order)}
+            self.rung_scores[-1] = [{position[kept_index[j]]: score for j, score in rung.items()} for rung in self.rung_scores[-1]]
+
+        best = int(np.argmax(self.scores))
+        # the individuals are never changed in place, the best one is shared with the population
+        self.best_organism = self.population[best]
+        self.best_score = self.scores[best]
 
         return self.best_organism, self.best_score
 
-    def training_function(self, model):
-        train(model, self.trainloader, self.batch_size)
-        return model
+    def emigrants(self, k):
+        "copies of the k best individuals with their scores, without stored weights"
+        best = np.argsort(self.scores, kind='stable')[::-1][:k]
+        return [(self.population[i].without_weights(), self.scores[i]) for i in best]
+
+    def immigrate(self, migrants):
+        '''
+        put the migrants of another island in the place of the worst individuals, the ones already in
+        the population are skipped; their scores are cached, they are not trained again
+        return: the number of migrants accepted
+        '''
+        fidelity = self.fidelity(self.halving[-1] if self.halving else TRAIN_FRACTION)
+        present = {x.genotype_hash() for x in self.population}
+        accepted = 0
+        for genotype, score in migrants:
+            key = genotype.genotype_hash()
+            if key in present:
+                continue
+            present.add(key)
+            if self.cache:
+                self.fitness_cache.setdefault(fidelity, {})[key] = score
+            self.replace_worst(genotype, score)
+            accepted += 1
+
+        order = np.argsort(self.scores, kind='stable')[::-1]
+        self.population = [self.population[x] for x in order]
+        self.scores = [self.scores[x] for x in order]
+        return accepted
+
+    def cost_of(self, netcode):
+        "the cost objective of the selection, lower is better"
+        if self.cost_objective == 'latency':
+            key = netcode.genotype_hash()
+            if key not in self.latencies:
+                self.latencies[key] = measure_latency(Net(netcode), self.input_shape, self.input_channels)
+            return self.latencies[key]
+        return netcode.cost()[self.cost_objective]
+
+    def prescreen_population(self, population):
+        "compute the proxy of the individuals never scored, tell which ones must be trained"
+        final = self.halving[-1] if self.halving else TRAIN_FRACTION
+        cache = self.fitness_cache.get(self.fidelity(final), {})
+
+        inputs, labels = proxy_batch(self.trainloader)
+        proxies = {}
+        for i, x in enumerate(population):
+            x.update_encoding()
+            if x.genotype_hash() not in cache:
+                proxies[i] = compute_proxy(self.prescreen, Net(x), inputs, labels)
+
+        keep = [True] * len(population)
+        if proxies:
+            threshold = np.percentile([p for p in proxies.values() if np.isfinite(p)] or [0], self.prescreen_percentile)
+            for i, p in proxies.items():
+                if not p >= threshold:
+                    keep[i] = False
+                    self.screened_out += 1
+        return keep
+
+    def fidelity(self, fraction):
+        "describes the training budget of score_genotype, scores of different fidelities are not comparable"
+        return (f"batch{self.batch_size}_frac{fraction}_epochs1" + ("_earlystop" if self.early_stop is not None else "")
+                + ("_inherit" if self.inherit_weights else "") + ("_bf16" if self.cpu_perf and bf16_supported() else ""))
+
+    def successive_halving(self, population):
+        "score the population with the budgets of self.halving, the individuals not promoted keep the score of their last rung"
+        scores = [None] * len(population)
+        candidates = list(range(len(population)))
+        rungs = []
+        for rung, fraction in enumerate(self.halving):
+            rung_scores = self.evaluate([population[i] for i in candidates], fraction)
+            rungs.append(dict(zip(candidates, rung_scores)))
+            for i, score in zip(candidates, rung_scores):
+                scores[i] = score
+
+            if rung < len(self.halving) - 1:
+                promoted = max(1, int(np.ceil(len(candidates) / self.eta)))
+                candidates = [candidates[j] for j in np.argsort(rung_scores, kind='stable')[::-1][:promoted]]
+
+        self.rung_scores.append(rungs)
+        return scores
+
+    def evaluate(self, population, fraction=TRAIN_FRACTION):
+        "score the population with the given training budget, the scores are returned in population order"
+        fidelity = self.fidelity(fraction)
+        cache = self.fitness_cache.setdefault(fidelity, {})
+        # Net would drop the invalid features anyway, do it before hashing so the key describes the trained network
+        for x in population:
+            x.update_encoding()
+        keys = [x.genotype_hash() for x in population]
+
+        # without the cache every individual is trained, also the duplicates
+        slots = keys if self.cache else list(range(len(population)))
+        scores = {}
+        to_train = {}
+        for slot, key, x in zip(slots, keys, population):
+            if self.cache and key in cache:
+                self.cache_hits += 1
+                scores[slot] = cache[key]
+            elif slot not in to_train:
+                to_train[slot] = (key, x)
+
+        if self.ledger is not None:
+            known = self.ledger.get_many({key for key, _ in to_train.values()}, fidelity)
+            for slot, (key, _) in list(to_train.items()):
+                if key in known:
+                    self.ledger_hits += 1
+                    scores[slot] = known[key]
+                    del to_train[slot]
+
+        genotypes = [x for _, x in to_train.values()]
+        options = self.training_options(fraction)
+        if self.evaluator is None and self.fuse > 1:
+            # the networks of a group are trained together, the reference of the early stop is the previous one
+            self.set_loss_reference([], fidelity)
+            results = score_genotypes_fused(genotypes, self.trainloader, self.testloader, self.batch_size, self.fuse, **options)
+        elif self.evaluator is None:
+            results = []
+            for x in genotypes:
+                # the reference is updated with the networks already trained in this generation
+                self.set_loss_reference(results, fidelity)
+                results.append(score_genotype(x, self.trainloader, self.testloader, self.batch_size, **options))
+        else:
+            self.set_loss_reference([], fidelity)
+            results = self.evaluator.map(genotypes, **options)
+
+        trained = {}
+        for (slot, (key, x)), (score, log) in zip(to_train.items(), results):
+            scores[slot] = score
+            trained[key] = score
+            if log is not None and log['stopped'] is not None:
+                self.aborted[key] = log['stopped']
+            # the workers train a copy of the genotype, its weights are brought back here
+            if log is not None and 'weights' in log:
+                x.set_weights(log.pop('weights'))
+        self.loss_reference[fidelity] = self.median_loss(results, self.loss_reference.get(fidelity))
+        if self.ledger is not None and trained:
+            self.ledger.put_many(trained, fidelity)
+
+        # the surrogate learns the scores of the full budget, also the ones read from the ledger
+        if fraction == (self.halving[-1] if self.halving else TRAIN_FRACTION):
+            for slot, key, x in zip(slots, keys, population):
+                if key not in self.surrogate_data:
+                    self.surrogate_data[key] = (featurize(x), scores[slot])
+
+        if self.cache:
+            cache.update((key, scores[key]) for key in keys)
+
+        return [scores[slot] for slot in slots]
+
+    def training_options(self, fraction):
+        "the keyword arguments of score_genotype"
+        return {'early_stop': self.early_stop, 'fraction': fraction, 'inherit': self.inherit_weights,
+                'eval_batch_size': self.eval_batch_size, 'cpu_perf': self.cpu_perf, 'compile': self.compile}
+
+    def median_loss(self, results, default=None):
+        "median smoothed final loss of the networks trained until the end"
+        losses = [log['loss'] for _, log in results if log is not None and log['stopped'] is None and log['loss'] is not None]
+        return float(np.median(losses)) if losses else default
+
+    def set_loss_reference(self, results, fidelity):
+        if self.early_stop is not None:
+            self.early_stop.reference = self.median_loss(results, self.loss_reference.get(fidelity))
+
+    def save_checkpoint(self, path, **extra):
+        "write the state of the evolution and the random states atomically, extra values are saved with them"
+        state = {'version': CHECKPOINT_VERSION, 'extra': extra,
+                 'random': (random.getstate(), np.random.get_state(), torch.get_rng_state())}
+        state.update((name, getattr(self, name)) for name in CHECKPOINT_ATTRIBUTES)
+
+        # a SIGTERM received while writing is delivered when the checkpoint is complete
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+
+    def load_checkpoint(self, path):
+        "restore the state written by save_checkpoint and return its extra values"
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f"checkpoint {path} has version {state.get('version')}, expected {CHECKPOINT_VERSION}")
+
+        for name in CHECKPOINT_ATTRIBUTES:
+            setattr(self, name, state[name])
+        python_state, numpy_state, torch_state = state['random']
+        random.setstate(python_state)
+        np.random.set_state(numpy_state)
+        torch.set_rng_state(torch_state)
+        return state['extra']
+
+    def close(self, wait=True):
+        "stop the worker processes and close the ledger, if any; without wait the pending trainings are cancelled"
+        if self.evaluator is not None:
+            # the offspring of steady_state still in training are not needed any more
+            for future in self.in_flight:
+                future.cancel()
+            self.evaluator.close(wait)
+        if self.ledger is not None:
+            self.ledger.close()
 
     def scoring_function(self, modelcode):
-        model = Net(modelcode)
-        model = self.training_function(model)
-        accuracy = eval(model, self.testloader)
-        
-        return accuracy
\ No newline at end of file
+        return self.evaluate([modelcode])[0]
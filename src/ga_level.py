@@ -1,5 +1,6 @@
 from src.dsge_level import *
 import sys
+import hashlib
 
 '''
 
@@ -68,6 +69,15 @@ class Net_encoding:
         else:
             return self.last_layer[0]
 
+    def set_module(self, i, module):
+        "put the module at position i, the module lists belong to this encoding while the modules may be shared"
+        if i < self.len_features():
+            self.features[i] = module
+        elif i < self.len_features() + self.len_classification():
+            self.classification[i - self.len_features()] = module
+        else:
+            self.last_layer[0] = module
+
     
     def compute_shape_features(self, input_shape = 32, max_len = None):
         "like the forward pass, compute the output shape of the features block"
@@ -80,16 +90,17 @@ class Net_encoding:
         return output_shape
     
     def setting_channels(self):
+        "derive the channels of each layer from the previous one, only the modules whose channels change are copied"
         c_in = self.input_channels
         for i in range(self._len()):
-            self.GA_encoding(i).param['input_channels'] = c_in
-            for j in range(self.GA_encoding(i).len()):
-                self.GA_encoding(i).layers[j].channels['in'] = c_in
-                if self.GA_encoding(i).layers[j].type == layer_type.CONV or self.GA_encoding(i).layers[j].type == layer_type.LINEAR:
-                    c_in = self.GA_encoding(i).layers[j].channels['out']
+            channels = []
+            for layer in self.GA_encoding(i).layers:
+                if layer.type == layer_type.CONV or layer.type == layer_type.LINEAR:
+                    channels.append((c_in, layer.channels['out']))
+                    c_in = layer.channels['out']
                 else:
-                    self.GA_encoding(i).layers[j].channels['out'] = c_in
-            self.GA_encoding(i).param['output_channels'] = self.GA_encoding(i).layers[-1].channels['out']
+                    channels.append((c_in, c_in))
+            self.set_module(i, self.GA_encoding(i).with_channels(channels))
         
         self.fix_first_classification()
     
@@ -121,6 +132,128 @@ class Net_encoding:
     def get_input_shape(self):
         return self.input_shape
 
+    def shape_trace(self):
+        """
+        propagate spatial size and channels through all the layers without building anything,
+        as Net would do after update_encoding and setting_channels. Returns the list of the layers as
+        dicts (module, layer, type, gene, in, out), where in and out are (channels, size) before the flatten
+        and (features,) after it, and the reason why the encoding is invalid, or None
+        """
+        trace = []
+        shape = self.input_shape
+        channels = self.input_channels
+        reason = None
+
+        if self.len_features() == 0:
+            reason = "no features module"
+
+        for i in range(self.len_features()):
+            for j, layer in enumerate(self.GA_encoding(i).layers):
+                c_out = layer.channels['out'] if layer.type == layer_type.CONV else channels
+                new_shape = shape
+                if layer.type == layer_type.CONV or layer.type == layer_type.POOLING:
+                    new_shape = layer.compute_shape(shape)
+                    # same rule of update_encoding, which would remove the module
+                    if reason is None and not shape > layer.param["kernel_size"]:
+                        reason = f"module {i}: kernel {layer.param['kernel_size']} not smaller than the input {shape}"
+                    elif reason is None and new_shape <= 0:
+                        reason = f"module {i}: output size {new_shape}"
+                trace.append({'module': i, 'layer': j, 'type': layer.type, 'gene': layer, 'in': (channels, shape), 'out': (c_out, new_shape)})
+                shape, channels = new_shape, c_out
+
+        features = channels * max(shape, 0) ** 2
+        if reason is None and features > MAX_FLATTEN:
+            reason = f"flatten of {features} features, more than {MAX_FLATTEN}"
+
+        for i in range(self.len_features(), self._len()):
+            module = self.GA_encoding(i)
+            # Net builds only the linear layer of the last block, the softmax is left to the loss
+            layers = module.layers[:1] if module.M_type == module_types.LAST_LAYER else module.layers
+            for j, layer in enumerate(layers):
+                out = layer.channels['out'] if layer.type == layer_type.LINEAR else features
+                trace.append({'module': i, 'layer': j, 'type': layer.type, 'gene': layer, 'in': (features,), 'out': (out,)})
+                features = out
+
+        return trace, reason
+
+    def cost(self, batch_size=1, bytes_per_value=4):
+        """
+        analytic cost of the network, computed from the shape trace without building it:
+            params: number of trainable parameters
+            macs: multiply-accumulate operations for one sample (pooling and batch norm count one per element read)
+            activation_memory: bytes of the largest input plus output of a layer, for a forward pass of batch_size samples
+        """
+        trace, _ = self.shape_trace()
+        params = macs = peak = 0
+        for entry in trace:
+            layer, kind = entry['gene'], entry['type']
+            c_in, c_out = entry['in'][0], entry['out'][0]
+            size_in = max(entry['in'][1], 0) ** 2 if len(entry['in']) == 2 else 1
+            size_out = max(entry['out'][1], 0) ** 2 if len(entry['out']) == 2 else 1
+
+            if kind == layer_type.CONV:
+                k = layer.param['kernel_size']
+                params += c_in * c_out * k * k + (c_out if layer.param['bias'] else 0)
+                macs += c_out * size_out * c_in * k * k
+            elif kind == layer_type.LINEAR:
+                params += c_in * c_out + c_out
+                macs += c_in * c_out
+            elif kind == layer_type.BATCH_NORM:
+                params += 2 * c_in
+                macs += c_in * size_in
+            elif kind == layer_type.POOLING:
+                adaptive = layer.param['pool_type'] in (pool.ADP_MAX, pool.ADP_AVG)
+                macs += c_in * size_in if adaptive else c_out * size_out * layer.param['kernel_size'] ** 2
+
+            peak = max(peak, c_in * size_in + c_out * size_out)
+
+        return {'params': int(params), 'macs': int(macs), 'activation_memory': int(peak * batch_size * bytes_per_value)}
+
+    def check_validity(self):
+        "tell if Net can be built from the encoding as it is, with the reason if it can not"
+        _, reason = self.shape_trace()
+        return reason is None, reason
+
+    def repair(self):
+        "remove the features modules which do not fit the input shape, tell if the encoding is then valid"
+        self.update_encoding()
+        return self.check_validity()
+
+    def signature(self):
+        "canonical description of the network: input, module types, layer types, params and channels"
+        return (self.input_shape, self.input_channels, self.param['output_channels'],
+                tuple(self.GA_encoding(i).signature() for i in range(self._len())))
+
+    def modules(self):
+        "all the modules, in the same order of GA_encoding"
+        return self.features + self.classification + self.last_layer
+
+    def set_weights(self, weights):
+        "store in each module the weights returned by Net.export_weights, in copies of the modules"
+        for i, w in enumerate(weights):
+            self.set_module(i, self.GA_encoding(i).with_weights(w))
+
+    def clone(self):
+        "copy of the encoding for the genetic operators, the modules are shared until an operator replaces them"
+        netcode = copy.copy(self)
+        netcode.features = list(self.features)
+        netcode.classification = list(self.classification)
+        netcode.last_layer = list(self.last_layer)
+        netcode.param = dict(self.param)
+        return netcode
+
+    def without_weights(self):
+        "copy of the encoding without the trained weights, the layers are shared"
+        netcode = copy.copy(self)
+        netcode.features = [m.without_weights() for m in self.features]
+        netcode.classification = [m.without_weights() for m in self.classification]
+        netcode.last_layer = [m.without_weights() for m in self.last_layer]
+        return netcode
+
+    def genotype_hash(self):
+        "stable hash of the signature, two encodings with the same hash build the same network"
+        return hashlib.sha1(repr(self.signature()).encode()).hexdigest()
+
     def get(self):
         return self.GA_encoding
         
@@ -141,8 +274,10 @@ class Net_encoding:
     def fix_first_classification(self):
         # fix in channels of the first classification block
         last_in = (self.compute_shape_features(self.input_shape) ** 2) * self.GA_encoding(self.len_features()-1).param['output_channels']
-        self.GA_encoding(self.len_features()).param['input_channels'] = last_in
-        self.GA_encoding(self.len_features()).layers[0].channels['in'] = last_in
+        module = self.GA_encoding(self.len_features())
+        channels = [(l.channels['in'], l.channels['out']) for l in module.layers]
+        channels[0] = (last_in, channels[0][1])
+        self.set_module(self.len_features(), module.with_channels(channels))
 
 
     def draw(self, gen, path):
@@ -216,25 +351,24 @@ def GA_bit_mask(parent1, parent2):
     mask2 = 1 - mask1
     p = [parent1, parent2]
 
-    child1 = Net_encoding(p[mask1[0]].len_features(), p[mask1[1]].len_classification(), p[mask1[0]].param['input_channels'], p[mask1[2]].param['output_channels'], p[mask1[0]].input_shape)
-    child2 = Net_encoding(p[mask2[0]].len_features(), p[mask2[1]].len_classification(), p[mask2[0]].param['input_channels'], p[mask2[2]].param['output_channels'], p[mask2[0]].input_shape)
-    # copy features
-    child1.features = copy.deepcopy(p[mask1[0]].features)
-    child2.features = copy.deepcopy(p[mask2[0]].features)
+    # the features (and the input) come from the first parent of the mask, the modules are shared with the parents
+    child1 = p[mask1[0]].clone()
+    child2 = p[mask2[0]].clone()
     # copy classification
-    child1.classification = copy.deepcopy(p[mask1[1]].classification)
-    child2.classification = copy.deepcopy(p[mask2[1]].classification)
+    child1.classification = list(p[mask1[1]].classification)
+    child2.classification = list(p[mask2[1]].classification)
     # copy last layer
-    child1.last_layer = copy.deepcopy(p[mask1[2]].last_layer)
-    child2.last_layer = copy.deepcopy(p[mask2[2]].last_layer)
-       
+    child1.last_layer = list(p[mask1[2]].last_layer)
+    child2.last_layer = list(p[mask2[2]].last_layer)
+    child1.param['output_channels'] = p[mask1[2]].param['output_channels']
+    child2.param['output_channels'] = p[mask2[2]].param['output_channels']
     
     return child1, child2
         
 
 
 def GA_one_point(parent1, parent2):
-    "cut the parent1 and parent2 at random position and swap the two parts"
+    "cut copies of parent1 and parent2 at random position and swap the two parts, the parents are left unchanged"
 
     # randomly choose if the cut is in the features or in the classification
     cut_parent1 = cut_parent2 = None
@@ -244,43 +378,39 @@ def GA_one_point(parent1, parent2):
     if type == module_types.FEATURES and parent1.len_features() > 1 and parent2.len_features() > 1:
         cut_parent1 = np.random.randint(1, parent1.len_features())
         # choose cut2 in order to not exceed maximum number of features block
-        cut_parent2 = np.random.randint(1, MAX_LEN_FEATURES -(parent1.len_features() - cut_parent1) + 1)
+        room = MAX_LEN_FEATURES - (parent1.len_features() - cut_parent1)
+        # a mutation can make the parent longer than the maximum, then there is no room for a cut
+        cut_parent2 = np.random.randint(1, room + 1) if room >= 1 else None
         #cut_parent2 = np.random.randint(1, parent2.len_features())
     
     elif type == module_types.CLASSIFICATION and parent1.len_classification() > 1 and parent2.len_classification() > 1:
         cut_parent1 = np.random.randint(parent1.len_features()+1, parent1._len()-1)
         # choose cut2 in order to not exceed maximum number of classification block
-        cut_parent2 = np.random.randint(1, MAX_LEN_CLASSIFICATION - (parent1.len_classification()  - (cut_parent1 - parent1.len_features())) + 1)
-        cut_parent2 = cut_parent2 + parent1.len_features()
+        room = MAX_LEN_CLASSIFICATION - (parent1.len_classification()  - (cut_parent1 - parent1.len_features()))
+        cut_parent2 = np.random.randint(1, room + 1) + parent1.len_features() if room >= 1 else None
         #cut_parent2 = np.random.randint(parent2.len_features()+1, parent2._len()-1)
 
     #print("cuts are: ", cut_parent1, ' ', cut_parent2)
+    child1, child2 = parent1.clone(), parent2.clone()
     
     # cut type
-    if cut_parent1: cut1_type = parent1.GA_encoding(cut_parent1).M_type 
+    if cut_parent1 and cut_parent2: cut1_type = parent1.GA_encoding(cut_parent1).M_type 
     else: cut1_type = None
 
+    # the module lists of the clones are new, the modules are shared with the parents
     if cut1_type == module_types.FEATURES:
-        aux1 = copy.deepcopy(parent1.features[cut_parent1:])
-        aux2 = copy.deepcopy(parent2.features[cut_parent2:])
+        aux1 = child1.features[cut_parent1:]
+        aux2 = child2.features[cut_parent2:]
 
-        parent1.features = copy.deepcopy(parent1.features[:cut_parent1])
-        parent2.features = copy.deepcopy(parent2.features[:cut_parent2])
-        
-        parent1.features.extend(aux2)
-        parent2.features.extend(aux1)
-     
+        child1.features = child1.features[:cut_parent1] + aux2
+        child2.features = child2.features[:cut_parent2] + aux1
 
     elif cut1_type == module_types.CLASSIFICATION:
-        aux1 = copy.deepcopy(parent1.classification[cut_parent1 - parent1.len_features():])
-        aux2 = copy.deepcopy(parent2.classification[cut_parent2 - parent2.len_features():])
+        aux1 = child1.classification[cut_parent1 - parent1.len_features():]
+        aux2 = child2.classification[cut_parent2 - parent2.len_features():]
 
-        parent1.classification = copy.deepcopy(parent1.classification[:cut_parent1 - parent1.len_features()])
-        parent2.classification = copy.deepcopy(parent2.classification[:cut_parent2 - parent2.len_features()])
-        
-        parent1.classification.extend(aux2)
-        parent2.classification.extend(aux1)
+        child1.classification = child1.classification[:cut_parent1 - parent1.len_features()] + aux2
+        child2.classification = child2.classification[:cut_parent2 - parent2.len_features()] + aux1
       
 
-    return parent1, parent2
-
+    return child1, child2
@@ -1,4 +1,5 @@
 from random import randint, uniform
+import os
 
 
 class Grammar:
@@ -19,6 +20,8 @@ class Grammar:
             Auxiliary function of the get_grammar method; loads the grammar from a file
         parse_grammar(path)
             Auxiliary fuction of the get_grammar method; parses the grammar to a dictionary
+        compile()
+            Precomputes the expansion tables used by initialise and decode
         _str_()
             Prints the grammar in the BNF form
         initialise(start_symbol)
@@ -41,7 +44,9 @@ class Grammar:
                 Path to the BNF grammar file
         """
         
+        self.path = path
         self.grammar = self.get_grammar(path)
+        self.compile()
 
 
     def get_grammar(self, path):
@@ -122,6 +127,38 @@ class Grammar:
         return grammar
 
 
+    def compile(self):
+        """
+            Precomputes the expansion tables used by initialise and decode, so that the
+            symbols are not split again at each expansion:
+            counts : dict
+                number of production rules of each non-terminal
+            expansions : dict
+                for each non-terminal, the list of its production rules; each symbol is a tuple
+                (symbol : str, non-terminal : bool, terminal : tuple or None), where terminal is
+                (name, type, number of values, min, max) for the [name,type,n,min,max] terminals
+        """
+
+        self.counts = {symbol: len(rules) for symbol, rules in self.grammar.items()}
+        self.expansions = {symbol: [[(sym, non_terminal, None if non_terminal else parse_terminal(sym))
+                                     for sym, non_terminal in rule] for rule in rules]
+                           for symbol, rules in self.grammar.items()}
+
+
+    # the grammar is read only and shared by all the modules, see load: copies are the same object
+    def __copy__(self):
+        return self
+
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+    def __reduce__(self):
+        # the parsed rules travel with the pickle, the other process does not need the file
+        return restore, (self.path, self.grammar)
+
+
     def _str_(self):
         """
         Prints the grammar in the BNF form
@@ -173,7 +210,7 @@ class Grammar:
 
         genotype = {}
 
-        self.initialise_recursive((start_symbol, True), None, genotype)
+        self.initialise_recursive((start_symbol, True, None), None, genotype)
 
         return genotype
 
@@ -185,20 +222,20 @@ class Grammar:
             Parameters
             ----------
             symbol : tuple
-                (non terminal symbol to expand : str, non-terminal : bool). 
+                (non terminal symbol to expand : str, non-terminal : bool, terminal : tuple). 
                 Non-terminal is True in case the non-terminal symbol is a 
                 non-terminal, and False if the the non-terminal symbol str is
-                a terminal
+                a terminal; terminal is the parsed [name,type,n,min,max] or None
             prev_nt: str
                 non-terminal symbol used in the previous expansion
             genotype: dict
                 DSGE genotype used for the inner-level of F-DENSER++ 
         """
 
-        symbol, non_terminal = symbol
+        symbol, non_terminal, terminal = symbol
 
         if non_terminal:
-            expansion_possibility = randint(0, len(self.grammar[symbol])-1)
+            expansion_possibility = randint(0, self.counts[symbol]-1)
 
             if symbol not in genotype:
                 genotype[symbol] = [{'ge': expansion_possibility, 'ga': {}}]
@@ -206,18 +243,13 @@ class Grammar:
                 genotype[symbol].append({'ge': expansion_possibility, 'ga': {}})
 
             add_reals_idx = len(genotype[symbol])-1 # just to estabilish nonterminal/terminal
-            for sym in self.grammar[symbol][expansion_possibility]:
+            for sym in self.expansions[symbol][expansion_possibility]:
                 self.initialise_recursive(sym, (symbol, add_reals_idx), genotype)
         else:
-            if '[' in symbol and ']' in symbol:
+            if terminal is not None:
                 genotype_key, genotype_idx = prev_nt
 
-                [var_name, var_type, num_values, min_val, max_val] = symbol.replace('[', '')\
-                                                                           .replace(']', '')\
-                                                                           .split(',')
-
-                num_values = int(num_values)
-                min_val, max_val = float(min_val), float(max_val)
+                var_name, var_type, num_values, min_val, max_val = terminal
 
                 if var_type == 'int':
                     values = [randint(min_val, max_val) for _ in range(num_values)]
@@ -245,7 +277,7 @@ class Grammar:
         """
 
         read_codons = dict.fromkeys(genotype.keys(), 0)
-        phenotype = self.decode_recursive((start_symbol, True),
+        phenotype = self.decode_recursive((start_symbol, True, None),
                                                      read_codons, genotype, '')
 
         return phenotype.lstrip().rstrip()
@@ -258,10 +290,10 @@ class Grammar:
             Parameters
             ----------
             symbol : tuple
-                (non terminal symbol to expand : str, non-terminal : bool). 
+                (non terminal symbol to expand : str, non-terminal : bool, terminal : tuple). 
                 Non-terminal is True in case the non-terminal symbol is a 
                 non-terminal, and False if the the non-terminal symbol str is
-                a terminal
+                a terminal; terminal is the parsed [name,type,n,min,max] or None
             read_integers : dict
                 index of the next codon of the non-terminal genotype to be read
             genotype : dict
@@ -270,7 +302,7 @@ class Grammar:
                 phenotype corresponding to the input genotype
         """
 
-        symbol, non_terminal = symbol
+        symbol, non_terminal, _ = symbol
 
         if non_terminal:
             if symbol not in read_integers:
@@ -278,27 +310,22 @@ class Grammar:
                 genotype[symbol] = []
 
             if len(genotype[symbol]) <= read_integers[symbol]:
-                ge_expansion_integer = randint(0, len(self.grammar[symbol])-1)
+                ge_expansion_integer = randint(0, self.counts[symbol]-1)
                 genotype[symbol].append({'ge': ge_expansion_integer, 'ga': {}})
 
             current_nt = read_integers[symbol]
             expansion_integer = genotype[symbol][current_nt]['ge'] #it hold the list of integer the code the rule
             read_integers[symbol] += 1
-            expansion = self.grammar[symbol][expansion_integer]
+            expansion = self.expansions[symbol][expansion_integer]
 
             used_terminals = []
             for sym in expansion:
                 if sym[1]:
                     phenotype = self.decode_recursive(sym, read_integers, genotype, phenotype)
                 else:
-                    if '[' in sym[0] and ']' in sym[0]:
-                        [var_name, var_type, var_num_values, var_min, var_max] = sym[0].replace('[', '')\
-                                                                                       .replace(']', '')\
-                                                                                       .split(',')
+                    if sym[2] is not None:
+                        var_name, var_type, var_num_values, var_min, var_max = sym[2]
                         if var_name not in genotype[symbol][current_nt]['ga']:
-                            var_num_values = int(var_num_values)
-                            var_min, var_max = float(var_min), float(var_max)
-
                             if var_type == 'int':
                                 values = [randint(var_min, var_max) for _ in range(var_num_values)]
                             elif var_type == 'float':
@@ -321,4 +348,35 @@ class Grammar:
                 for name in used_terminals:
                     del genotype[symbol][current_nt]['ga'][name]
 
-        return phenotype
\ No newline at end of file
+        return phenotype
+
+
+def parse_terminal(symbol):
+    "(name, type, number of values, min, max) of a [name,type,n,min,max] terminal, None for the other terminals"
+    if '[' not in symbol or ']' not in symbol:
+        return None
+    [var_name, var_type, num_values, min_val, max_val] = symbol.replace('[', '').replace(']', '').split(',')
+    return var_name, var_type, int(num_values), float(min_val), float(max_val)
+
+
+# absolute path of the grammar file -> Grammar, each file is read and compiled once per process
+_grammars = {}
+
+def load(path):
+    "the Grammar of the file, read the first time and then shared by all the modules of the process"
+    key = os.path.abspath(path)
+    if key not in _grammars:
+        _grammars[key] = Grammar(path)
+    return _grammars[key]
+
+
+def restore(path, grammar):
+    "unpickle a Grammar: the one of the registry if the file was already loaded, otherwise it is built from the pickled rules"
+    key = os.path.abspath(path)
+    if key not in _grammars:
+        instance = Grammar.__new__(Grammar)
+        instance.path = path
+        instance.grammar = grammar
+        instance.compile()
+        _grammars[key] = instance
+    return _grammars[key]
@@ -0,0 +1,136 @@
+from src.evolution import *
+
+import multiprocessing as mp
+import queue
+import csv
+
+'''
+
+This file contains the island model: several populations evolve in separate processes and, every few
+generations, each island sends copies of its best networks to its neighbours, which replace their worst ones.
+
+'''
+
+TOPOLOGIES = ('ring', 'full', 'star', 'none')
+
+
+def neighbours(topology, islands):
+    "island -> the islands which receive its migrants"
+    if topology == 'ring':
+        return {k: [(k + 1) % islands] for k in range(islands)} if islands > 1 else {0: []}
+    if topology == 'full':
+        return {k: [j for j in range(islands) if j != k] for k in range(islands)}
+    if topology == 'star':
+        # island 0 is the hub, it exchanges with all the others
+        return {k: ([j for j in range(1, islands)] if k == 0 else [0]) for k in range(islands)}
+    if topology == 'none':
+        return {k: [] for k in range(islands)}
+    raise ValueError(f"unknown topology {topology}, expected one of {TOPOLOGIES}")
+
+
+def _run_island(k, seed, options, num_generations, every, migrants, destinations, sources, inboxes, stats):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    env = evolution(**options)
+    early = {}      # generation -> migrants received from islands which are already ahead
+    for i in range(num_generations):
+        env.generation()
+        env.get_best_organism()
+
+        accepted = 0
+        if (i + 1) % every == 0 and i + 1 < num_generations:
+            for j in destinations:
+                inboxes[j].put((i, env.emigrants(migrants)))
+            # the migration is synchronous, every island waits for the migrants of its sources in this generation
+            arrived = early.pop(i, [])
+            while len(arrived) < len(sources):
+                generation, genotypes = inboxes[k].get()
+                if generation == i:
+                    arrived.append(genotypes)
+                else:
+                    early.setdefault(generation, []).append(genotypes)
+            accepted = env.immigrate([m for genotypes in arrived for m in genotypes])
+
+        stats.put(('generation', k, i, {'best': env.best_score, 'mean': float(np.mean(env.scores)),
+                                        'immigrants': accepted, 'cache_hits': env.cache_hits,
+                                        'duplicate_rate': env.duplicate_rate()}))
+
+    env.close()
+    stats.put(('done', k, env.best_organism.without_weights(), env.best_score))
+
+
+def run_islands(dataset, islands=4, population_size=10, num_generations=10, batch_size=4, subpath='', topology='ring',
+                every=5, migrants=2, seed=0, **evolution_options):
+    '''
+    input:
+        - the dataset we want to train the populations on
+        - islands: the number of populations, each one evolved by its own process
+        - population_size, num_generations, batch_size: as in main.run_evolution, for each island
+        - subpath: the path where we want to save the results
+        - topology: ring, full, star (island 0 is the hub) or none (independent runs)
+        - every: the number of generations between two migrations
+        - migrants: how many of its best networks each island sends to each neighbour
+        - seed: the random seed of island k is seed + k
+        - evolution_options: the other arguments of evolution, the same for every island
+    return: the best network and its score over all the islands
+    '''
+    path = 'results/' + subpath
+    os.makedirs(path, exist_ok=True)
+
+    destinations = neighbours(topology, islands)
+    sources = {k: [j for j in range(islands) if k in destinations[j]] for k in range(islands)}
+    options = dict(evolution_options, population_size=population_size, holdout=0.6, mating=True, dataset=dataset,
+                   batch_size=batch_size)
+
+    context = mp.get_context('spawn')
+    inboxes = [context.Queue() for _ in range(islands)]
+    stats = context.Queue()
+    processes = [context.Process(target=_run_island, args=(k, seed + k, options, num_generations, every, migrants,
+                                                           destinations[k], sources[k], inboxes, stats))
+                 for k in range(islands)]
+    for p in processes:
+        p.start()
+
+    rows = {}       # (generation, island) -> statistics
+    best = {}       # island -> (best network, score)
+    while len(best) < islands:
+        try:
+            kind, k, *message = stats.get(timeout=10)
+        except queue.Empty:
+            # an island which died would leave the others waiting for its migrants forever
+            failed = [k for k, p in enumerate(processes) if p.exitcode not in (None, 0)]
+            if failed:
+                for p in processes:
+                    p.terminate()
+                raise RuntimeError(f"islands {failed} failed")
+            continue
+        if kind == 'generation':
+            i, row = message
+            rows[(i, k)] = row
+            print(f"Island {k} generation {i}: best {row['best']}%, mean {row['mean']:.2f}%, immigrants {row['immigrants']}")
+        else:
+            best[k] = tuple(message)
+    for p in processes:
+        p.join()
+
+    with open(f'{path}/islands.csv', 'w+', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['generation', 'island', 'best_accuracy', 'mean_accuracy', 'immigrants', 'cache_hits', 'duplicate_rate'])
+        writer.writerows([i, k, r['best'], r['mean'], r['immigrants'], r['cache_hits'], r['duplicate_rate']] for (i, k), r in sorted(rows.items()))
+
+    # the best and the mean of all the islands, generation by generation
+    with open(f'{path}/islands_global.csv', 'w+', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['generation', 'best_accuracy', 'best_island', 'mean_accuracy'])
+        for i in range(num_generations):
+            generation = {k: rows[(i, k)] for k in range(islands)}
+            top = max(generation, key=lambda k: generation[k]['best'])
+            writer.writerow([i, generation[top]['best'], top, np.mean([r['mean'] for r in generation.values()])])
+
+    top = max(best, key=lambda k: best[k][1])
+    with open(f'{path}/best_organism.pkl', 'wb') as f:
+        pickle.dump(best[top][0], f)
+    print(f"Best accuracy obtained: {best[top][1]}% on island {top}")
+    return best[top]
@@ -0,0 +1,72 @@
+import sqlite3
+import time
+
+'''
+
+This file contains the persistent store of the fitness scores, shared by all the runs
+which use the same file. Each score is identified by the genotype hash, the dataset
+and the training fidelity (how much the network was trained before being scored).
+
+'''
+
+# how long a writer waits for the lock held by another process before failing
+LOCK_TIMEOUT = 600
+
+
+class FitnessLedger:
+    "SQLite table of the scores, safe to be read and written by several processes at the same time."
+    def __init__(self, path, dataset, fidelity):
+        '''
+        path: the SQLite file, created if it does not exist
+        dataset: the name of the dataset the networks are trained on
+        fidelity: a string which describes the training budget of each score
+        '''
+        self.path = path
+        self.dataset = dataset
+        self.fidelity = fidelity
+
+        # the default rollback journal is used instead of WAL, which does not work on network file systems
+        self.conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS fitness (
+                                genotype TEXT NOT NULL,
+                                dataset TEXT NOT NULL,
+                                fidelity TEXT NOT NULL,
+                                score REAL NOT NULL,
+                                created REAL NOT NULL,
+                                PRIMARY KEY (genotype, dataset, fidelity))''')
+
+    def get_many(self, keys, fidelity=None):
+        "return a dict genotype hash -> score of the keys already in the ledger"
+        fidelity = fidelity or self.fidelity
+        found = {}
+        keys = list(keys)
+        # sqlite limits the number of parameters of a query
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.conn.execute(f'''SELECT genotype, score FROM fitness
+                                         WHERE dataset = ? AND fidelity = ? AND genotype IN ({','.join('?' * len(chunk))})''',
+                                     [self.dataset, fidelity] + chunk)
+            found.update(rows.fetchall())
+        return found
+
+    def get(self, key, fidelity=None):
+        return self.get_many([key], fidelity).get(key)
+
+    def put_many(self, scores, fidelity=None):
+        "store a dict genotype hash -> score, the first score written for a key is kept"
+        fidelity = fidelity or self.fidelity
+        now = time.time()
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR IGNORE INTO fitness VALUES (?, ?, ?, ?, ?)',
+                                  [(key, self.dataset, fidelity, float(score), now) for key, score in scores.items()])
+
+    def put(self, key, score, fidelity=None):
+        self.put_many({key: score}, fidelity)
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM fitness WHERE dataset = ? AND fidelity = ?',
+                                 (self.dataset, self.fidelity)).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
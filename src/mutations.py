@@ -61,21 +61,14 @@ def GA_add(offspring, cut, module):
 
     # add control to check if we have reached the maximum number of modules
     # only features and classification modules can be added (replaced)
+    # the modules are never changed in place, the new list shares them with the other encodings
     if module.M_type == module_types.FEATURES:
-        tmp = copy.deepcopy(offspring.features[cut:])
-        offspring.features = copy.deepcopy(offspring.features[:cut + 1])
-
-        # add the module
-        offspring.features[cut] = copy.deepcopy(module)
-        offspring.features.extend(tmp) # add the rest of the modules
+        # add the module before the rest of the modules
+        offspring.features = offspring.features[:cut] + [module] + offspring.features[cut:]
 
     elif module.M_type == module_types.CLASSIFICATION:
-        tmp = copy.deepcopy( offspring.classification[cut - offspring.len_features():]  )
-        offspring.classification = copy.deepcopy(offspring.classification[:cut - offspring.len_features() + 1])
-        
-        # add the module
-        offspring.classification[cut- offspring.len_features()] = copy.deepcopy(module)
-        offspring.classification.extend(tmp) # add the rest of the modules
+        cut = cut - offspring.len_features()
+        offspring.classification = offspring.classification[:cut] + [module] + offspring.classification[cut:]
              
 
   
@@ -97,8 +90,8 @@ def GA_replace(offspring):
         elif cut_type == module_types.CLASSIFICATION:
             cut2 = np.random.randint(offspring.len_features(), offspring._len()-1)
         
-        # The copy must be done by reference
-        module = copy.deepcopy(offspring.GA_encoding(cut1)) # determine the module to copy
+        # The copy is done by reference, the modules are never changed in place
+        module = offspring.GA_encoding(cut1) # determine the module to copy
         GA_add(offspring, cut2, module)
 
 
@@ -182,37 +175,15 @@ def grammatical_mutation(offspring):
     
     print("grammatical mutation", gene_type)
 
-    if gene_type == module_types.FEATURES:
-        #choose a layer inside the gene
-        layer = np.random.randint(0, offspring.features[gene].len())
-        #identify the layer
-        type = offspring.features[gene].layers[layer].type # this if you want to let unchanged the type of the layer
-        #build a new layer mantaining the same type and the number of channels
-        new_layer = Layer(type,  c_out = offspring.features[gene].layers[layer].channels['out'])  
-        # add the new layer
-        offspring.features[gene].layers[layer] = new_layer
-        
-
-    elif gene_type == module_types.CLASSIFICATION:
-        #choose a layer inside the gene
-        layer = np.random.randint(0, offspring.classification[gene - offspring.len_features()].len())
-        #identify the layer
-        type = offspring.classification[gene - offspring.len_features()].layers[layer].type
-        #build a new layer mantaining the same type and the number of channels
-        new_layer = Layer(type, c_out = offspring.classification[gene - offspring.len_features()].layers[layer].channels['out'])
-        # add the new layer
-        offspring.classification[gene - offspring.len_features()].layers[layer] = new_layer
-
-    else:
-        #choose a layer inside the gene
-        layer = np.random.randint(0, offspring.last_layer[0].len())
-        #identify the layer
-        type = offspring.last_layer[0].layers[layer].type
-        #build a new layer mantaining the same type and the number of channels
-        new_layer = Layer(type,  c_out = offspring.last_layer[0].layers[layer].channels['out'])
-
-        # add the new layer
-        offspring.last_layer[0].layers[layer] = new_layer
+    module = offspring.GA_encoding(gene)
+    #choose a layer inside the gene
+    layer = np.random.randint(0, module.len())
+    #identify the layer
+    type = module.layers[layer].type # this if you want to let unchanged the type of the layer
+    #build a new layer mantaining the same type and the number of channels
+    new_layer = Layer(type,  c_out = module.layers[layer].channels['out'])
+    # add the new layer in a copy of the module, the parents may share it
+    offspring.set_module(gene, module.with_layer(layer, new_layer))
 
     offspring.fix_first_classification()
 
@@ -232,13 +203,7 @@ def integer_mutation(offspring):
 
     print("integer mutation", gene_type)
     #replace new gene
-    if gene_type == module_types.FEATURES:
-        offspring.features[gene] = new_module
-
-    elif gene_type == module_types.CLASSIFICATION:
-        offspring.classification[gene - offspring.len_features()] = new_module
-    else:
-        offspring.last_layer[0] = new_module
+    offspring.set_module(gene, new_module)
 
     offspring.fix_first_classification()
 
@@ -30,7 +30,7 @@ class Net(nn.Module):
 
         self.layer_list.append(self.make_layer(Net_encod.last_layer[0].layers[0]) )
         self.layers = nn.Sequential(*self.layer_list)
-        self.Net_encoding = Net_encod
+        self.rebind(Net_encod)
         
         
 
@@ -63,6 +63,48 @@ class Net(nn.Module):
     def forward(self, x):
         out = self.layers(x)
         return out
+
+    def rebind(self, Net_encod):
+        "attach the network to an encoding with the same architecture, the weights are left unchanged"
+        self.Net_encoding = Net_encod
+        # (position of the module in the encoding, index of the layer in the module) of each element of layer_list,
+        # None for Flatten; the same module object can be at two positions, with different weights
+        n_features = Net_encod.len_features()
+        self.origin = [(i, j) for i in range(n_features) for j in range(Net_encod.GA_encoding(i).len())] + [None]
+        self.origin += [(i, j) for i in range(n_features, Net_encod._len() - 1) for j in range(Net_encod.GA_encoding(i).len())]
+        self.origin.append((Net_encod._len() - 1, 0))
+
+    def reset_parameters(self):
+        "draw new random weights and forget the batch norm statistics, as in a newly built network"
+        for layer in self.layer_list:
+            if hasattr(layer, 'reset_parameters'):
+                layer.reset_parameters()
+
+    def export_weights(self):
+        "copy the trained weights in the modules of the encoding, the offspring which share a module can inherit them"
+        weights = [{} for _ in range(self.Net_encoding._len())]
+        for layer, origin in zip(self.layer_list, self.origin):
+            state = layer.state_dict()
+            if origin is not None and state:
+                i, j = origin
+                weights[i][j] = {k: v.detach().cpu().clone() for k, v in state.items()}
+        self.Net_encoding.set_weights(weights)
+        return weights
+
+    def inherit_weights(self):
+        "load the weights stored in the modules wherever the layer has the same parameters, return how many layers were loaded"
+        inherited = 0
+        for layer, origin in zip(self.layer_list, self.origin):
+            if origin is None or not getattr(self.Net_encoding.GA_encoding(origin[0]), 'weights', None):
+                continue
+            i, j = origin
+            stored = self.Net_encoding.GA_encoding(i).weights.get(j)
+            state = layer.state_dict()
+            # channels or flatten size may have changed since the weights were stored
+            if stored and stored.keys() == state.keys() and all(stored[k].shape == state[k].shape for k in state):
+                layer.load_state_dict(stored)
+                inherited += 1
+        return inherited
  
     def len(self):
         return len(self.layer_list)
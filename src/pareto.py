@@ -0,0 +1,123 @@
+import numpy as np
+import pickle
+import csv
+import os
+
+'''
+
+This file contains the NSGA-II selection on several objectives (accuracy and the cost of the
+network) and the archive of the Pareto front found during the whole evolution.
+All the objectives are minimized, the accuracy enters as its opposite.
+
+'''
+
+
+def dominates(a, b):
+    "a is not worse than b in every objective and better in at least one"
+    return all(x <= y for x, y in zip(a, b)) and any(x < y for x, y in zip(a, b))
+
+
+def non_dominated_sort(objectives):
+    "list of fronts, each a list of indices; the first front is the Pareto front"
+    n = len(objectives)
+    dominated_by = [[] for _ in range(n)]   # the individuals each one dominates
+    count = [0] * n                         # how many individuals dominate each one
+    for i in range(n):
+        for j in range(i + 1, n):
+            if dominates(objectives[i], objectives[j]):
+                dominated_by[i].append(j)
+                count[j] += 1
+            elif dominates(objectives[j], objectives[i]):
+                dominated_by[j].append(i)
+                count[i] += 1
+
+    fronts = [[i for i in range(n) if count[i] == 0]]
+    while fronts[-1]:
+        following = []
+        for i in fronts[-1]:
+            for j in dominated_by[i]:
+                count[j] -= 1
+                if count[j] == 0:
+                    following.append(j)
+        fronts.append(following)
+    return fronts[:-1]
+
+
+def crowding_distance(objectives, front):
+    "distance of each individual of the front from its neighbours, the extremes are infinitely far"
+    distance = {i: 0.0 for i in front}
+    for m in range(len(objectives[front[0]])):
+        ordered = sorted(front, key=lambda i: objectives[i][m])
+        low, high = objectives[ordered[0]][m], objectives[ordered[-1]][m]
+        distance[ordered[0]] = distance[ordered[-1]] = np.inf
+        if high == low:
+            continue
+        for k in range(1, len(ordered) - 1):
+            distance[ordered[k]] += (objectives[ordered[k + 1]][m] - objectives[ordered[k - 1]][m]) / (high - low)
+    return distance
+
+
+def nsga2_order(objectives, valid=None):
+    '''
+    indices sorted by front and, inside each front, by decreasing crowding distance
+    valid: for each individual, False if its objectives are not real (a network which was never trained);
+           these are dominated by all the others and come last, in their order
+    '''
+    ranked = [i for i in range(len(objectives)) if valid is None or valid[i]]
+    points = [objectives[i] for i in ranked]
+    order = []
+    for front in non_dominated_sort(points):
+        distance = crowding_distance(points, front)
+        order.extend(ranked[j] for j in sorted(front, key=lambda j: -distance[j]))
+    return order + [i for i in range(len(objectives)) if valid is not None and not valid[i]]
+
+
+class ParetoArchive:
+    "Non dominated (accuracy, cost) networks found during the evolution, saved on disk after each update."
+    def __init__(self, path=None, cost_name='cost', resume=False):
+        '''
+        path: pickle file of the archive
+        cost_name: name of the cost objective, used in the csv
+        resume: read back the archive of the run being resumed; otherwise the archive of a previous run
+                in the same path is removed
+        '''
+        self.path = path
+        self.cost_name = cost_name
+        self.entries = {}   # genotype hash -> (genotype, accuracy, cost)
+        if path is not None and os.path.exists(path):
+            if resume:
+                with open(path, 'rb') as f:
+                    self.entries = pickle.load(f)
+            else:
+                os.remove(path)
+
+    def update(self, candidates):
+        "candidates: list of (genotype hash, genotype, accuracy, cost), returns the size of the front"
+        for key, genotype, accuracy, cost in candidates:
+            if key not in self.entries:
+                self.entries[key] = (genotype.without_weights(), accuracy, cost)
+
+        keys = list(self.entries)
+        # no network was ever archived, e.g. every candidate of the first generation was aborted
+        fronts = non_dominated_sort([(-self.entries[k][1], self.entries[k][2]) for k in keys])
+        self.entries = {keys[i]: self.entries[keys[i]] for i in (fronts[0] if fronts else [])}
+        if self.path is not None:
+            self.save()
+        return len(self.entries)
+
+    def front(self):
+        "the entries sorted by decreasing accuracy"
+        return sorted(self.entries.items(), key=lambda item: -item[1][1])
+
+    def save(self):
+        # write and rename, a job killed while writing leaves the previous archive
+        with open(self.path + '.tmp', 'wb') as f:
+            pickle.dump(self.entries, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def write_csv(self, path):
+        with open(path, 'w+', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['genotype', 'accuracy', self.cost_name, 'num_layers'])
+            for key, (genotype, accuracy, cost) in self.front():
+                writer.writerow([key, accuracy, cost, genotype._len()])
@@ -0,0 +1,173 @@
+from src.compact import compact, from_bytes
+
+import numpy as np
+import threading
+import queue
+import time
+import csv
+import os
+
+'''
+
+This file contains the log of a run: one chunk per generation, a .npz file with a column for each statistic
+of the individuals and their genotypes in the compact binary format (src.compact). The chunks are written by
+a background thread, so that the evolution never waits for the disk, and each one appears atomically:
+a reader can follow the log while the run is in progress.
+
+'''
+
+# the columns of each chunk besides the genotypes, in the order of all_generations_data.csv
+COLUMNS = ('generation', 'individual', 'accuracy', 'num_layers', 'best_accuracy', 'best_num_layers',
+           'params', 'macs', 'activation_memory')
+# written by close, the readers which follow the log stop when they find it
+CLOSED = 'closed'
+# seconds between two scans of the directory of a reader which follows the log
+POLL_INTERVAL = 1.0
+
+
+def chunk_name(generation):
+    return f"gen{generation:05d}.npz"
+
+def chunk_generation(name):
+    return int(name[3:-4])
+
+def chunks(path):
+    "names of the complete chunks, in order of generation"
+    return sorted(name for name in os.listdir(path) if name.startswith('gen') and name.endswith('.npz'))
+
+def load_chunk(path, name):
+    with np.load(os.path.join(path, name)) as f:
+        return dict(f)
+
+
+def make_batch(generation, stats, best_score, best_net):
+    '''
+    the columns of a generation
+    stats: the list of population_stats() of evolution, one dict for each individual
+    best_score, best_net: the best network found so far and its score
+    '''
+    batch = {
+        'generation': np.full(len(stats), generation, dtype=np.int32),
+        'individual': np.array([s['individual'] for s in stats], dtype=np.int32),
+        'accuracy': np.array([s['score'] for s in stats], dtype=np.float64),
+        'num_layers': np.array([s['len'] for s in stats], dtype=np.int32),
+        'best_accuracy': np.full(len(stats), best_score, dtype=np.float64),
+        'best_num_layers': np.full(len(stats), best_net._len(), dtype=np.int32),
+    }
+    for cost in ('params', 'macs', 'activation_memory'):
+        batch[cost] = np.array([s['cost'][cost] for s in stats], dtype=np.int64)
+    # the genotypes have different lengths: their bytes one after the other, and where each one ends
+    genotypes = [compact(s['genotype']).to_bytes() for s in stats]
+    batch['genotypes'] = np.frombuffer(b''.join(genotypes), dtype=np.uint8)
+    batch['genotype_ends'] = np.cumsum([len(data) for data in genotypes], dtype=np.int64)
+    return batch
+
+
+def genotypes(batch):
+    "the Net_encoding of each row of a chunk"
+    data = batch['genotypes'].tobytes()
+    starts = [0] + list(batch['genotype_ends'][:-1])
+    return [from_bytes(data[start:end]).to_encoding() for start, end in zip(starts, batch['genotype_ends'])]
+
+
+class RunLog:
+    "Append-only log of the generations of a run, written by a background thread."
+    def __init__(self, path, resume_after=None, pending=()):
+        '''
+        path: the directory of the chunks, created if needed
+        resume_after: the last generation of the checkpoint the run is resumed from, the chunks of the
+                      following generations are removed; None for a new run, every chunk is removed
+        pending: the batches which were not written yet when the checkpoint was saved, see pending()
+        '''
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            stale = name == CLOSED or name.endswith('.tmp')
+            if stale or (name.endswith('.npz') and (resume_after is None or chunk_generation(name) > resume_after)):
+                os.remove(os.path.join(path, name))
+
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.unwritten = {}     # generation -> batch, until its chunk is on disk
+        self.error = None
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+        for generation, batch in pending:
+            self.append(generation, batch)
+
+    def append(self, generation, batch):
+        "queue the columns of a generation (see make_batch), they are written in the background"
+        if self.error is not None:
+            raise RuntimeError(f"the run log {self.path} can not be written") from self.error
+        with self.lock:
+            self.unwritten[generation] = batch
+        self.queue.put((generation, batch))
+
+    def pending(self):
+        "the (generation, batch) not written yet, to be saved with a checkpoint and given back to a resumed log"
+        with self.lock:
+            return sorted(self.unwritten.items(), key=lambda item: item[0])
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            generation, batch = item
+            try:
+                tmp = os.path.join(self.path, chunk_name(generation) + '.tmp')
+                with open(tmp, 'wb') as f:
+                    np.savez_compressed(f, **batch)
+                os.replace(tmp, os.path.join(self.path, chunk_name(generation)))
+            except Exception as e:
+                self.error = e
+                continue
+            with self.lock:
+                self.unwritten.pop(generation, None)
+
+    def close(self):
+        "write the batches still in the queue and mark the log as complete"
+        self.queue.put(None)
+        self.writer.join()
+        if self.error is not None:
+            raise RuntimeError(f"the run log {self.path} can not be written") from self.error
+        open(os.path.join(self.path, CLOSED), 'w').close()
+
+
+def read_runlog(path):
+    "all the chunks written so far, concatenated column by column"
+    batches = [load_chunk(path, name) for name in chunks(path)]
+    if not batches:
+        return {}
+    columns = {name: np.concatenate([b[name] for b in batches]) for name in COLUMNS}
+    # the ends of the genotypes are relative to their chunk
+    offsets = np.cumsum([0] + [len(b['genotypes']) for b in batches[:-1]])
+    columns['genotypes'] = np.concatenate([b['genotypes'] for b in batches])
+    columns['genotype_ends'] = np.concatenate([b['genotype_ends'] + offset for b, offset in zip(batches, offsets)])
+    return columns
+
+
+def follow_runlog(path, poll_interval=POLL_INTERVAL):
+    "yield the chunks as dicts of columns as soon as they are written, until the run log is closed"
+    seen = set()
+    while True:
+        # the marker is checked before the scan, so that the chunks written just before it are not missed
+        closed = os.path.exists(os.path.join(path, CLOSED))
+        for name in chunks(path) if os.path.isdir(path) else []:
+            if name not in seen:
+                seen.add(name)
+                yield load_chunk(path, name)
+        if closed:
+            return
+        time.sleep(poll_interval)
+
+
+def write_csv(path, csv_path):
+    "the columns of the run log (without the genotypes) as all_generations_data.csv, read by plot_results"
+    columns = read_runlog(path)
+    with open(csv_path, 'w+', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        if columns:
+            rows = zip(*(columns[name].tolist() for name in COLUMNS))
+            writer.writerows(rows)
@@ -0,0 +1,65 @@
+from src.nn_encoding import *
+
+'''
+
+This file contains a surrogate of the fitness: each evaluated genotype is turned into a
+fixed length vector of features and a ridge regression is fitted on the scores, so that
+many proposed offspring can be ranked before training any of them.
+
+'''
+
+# the surrogate is used only after this number of scored genotypes
+MIN_SAMPLES = 20
+
+
+def featurize(netcode):
+    "fixed length numeric description of the genotype, computed from the encoding only"
+    counts = np.zeros(len(layer_type) + len(pool) + len(activation))
+    # one slot per feature module: conv, pool, kernel, stride, same padding, output channels
+    features = np.zeros((MAX_LEN_FEATURES, 6))
+    # one slot per classification module: width (crossover can exceed the maximum length, the extra ones are only counted)
+    widths = np.zeros(MAX_LEN_CLASSIFICATION)
+
+    shape = netcode.input_shape
+    channels = netcode.input_channels
+    for i, module in enumerate(netcode.modules()):
+        for layer in module.layers:
+            counts[layer.type.value] += 1
+            if layer.type == layer_type.POOLING:
+                counts[len(layer_type) + layer.param['pool_type'].value] += 1
+            elif layer.type == layer_type.ACTIVATION:
+                counts[len(layer_type) + len(pool) + layer.param.value] += 1
+
+        if module.M_type == module_types.FEATURES and i < MAX_LEN_FEATURES:
+            main = module.layers[0]
+            if main.type == layer_type.CONV:
+                channels = main.channels['out']
+            features[i] = [main.type == layer_type.CONV, main.type == layer_type.POOLING,
+                           main.param['kernel_size'], main.param['stride'], main.param['padding'] == 'same', channels]
+            shape = max(main.compute_shape(shape), 0)
+        elif module.M_type == module_types.CLASSIFICATION and i - netcode.len_features() < MAX_LEN_CLASSIFICATION:
+            widths[i - netcode.len_features()] = module.layers[0].channels['out']
+
+    flatten = shape ** 2 * channels
+    summary = [netcode.len_features(), netcode.len_classification(), shape, np.log1p(flatten)]
+    return np.concatenate([summary, counts, features.ravel(), np.log1p(widths)]).astype(float)
+
+
+class RidgeSurrogate:
+    "Ridge regression on standardized features, fitted in closed form."
+    def __init__(self, alpha=1.0):
+        self.alpha = alpha
+        self.weights = None
+
+    def fit(self, X, y):
+        X, y = np.asarray(X, dtype=float), np.asarray(y, dtype=float)
+        self.mean = X.mean(axis=0)
+        self.std = X.std(axis=0) + 1e-8
+        self.y_mean = y.mean()
+        Z = (X - self.mean) / self.std
+        self.weights = np.linalg.solve(Z.T @ Z + self.alpha * np.eye(Z.shape[1]), Z.T @ (y - self.y_mean))
+        return self
+
+    def predict(self, X):
+        Z = (np.asarray(X, dtype=float) - self.mean) / self.std
+        return Z @ self.weights + self.y_mean
@@ -1,6 +1,14 @@
 from src.evolution import *
 from scripts.train import test_model
 from scripts.dataloader import MNIST, cifar10
+from src.pareto import non_dominated_sort, crowding_distance, nsga2_order, ParetoArchive
+from src.broker import SpoolEvaluator
+from src.compact import compact, from_bytes
+from src.runlog import RunLog, make_batch, read_runlog, genotypes
+import subprocess
+import tempfile
+import time
+import tracemalloc
 import sys
 
 # set std param for MNIST dataset on which we will test the network
@@ -160,6 +168,174 @@ def test_evolution(trainloader):
         nets = new_population
 
 
+def test_genotype_hash():
+    netcode = generate_random_net()
+    netcode.update_encoding()
+    twin = copy.deepcopy(netcode)
+
+    print(bcolors.HEADER + "\nTesting the genotype hash of a copied and of a mutated network" + bcolors.ENDC)
+    assert netcode.genotype_hash() == twin.genotype_hash(), "Should be True if a copy has the same hash"
+
+    # channels are derived while building the network, they must not change the hash
+    Net(twin)
+    assert netcode.genotype_hash() == twin.genotype_hash(), "Should be True if building the net leaves the hash unchanged"
+
+    # the addition of a module always changes the genotype, the original and its clones keep their hash
+    clone = netcode.clone()
+    mutant = netcode.clone()
+    GA_mutation(mutant, ga_mutation_type.ADDITION)
+    assert mutant._len() == netcode._len() + 1, "Should be True if a module was added"
+    assert mutant.genotype_hash() != netcode.genotype_hash(), "Should be True if a mutated network has a different hash"
+    assert clone.genotype_hash() == netcode.genotype_hash(), "Should be True if a clone keeps the hash of the original"
+
+
+def test_copy_on_write(num_ops = 50):
+    print(bcolors.HEADER + "\nTesting that crossover and mutation leave the parents unchanged" + bcolors.ENDC)
+    parents = [generate_random_net() for _ in range(2)]
+    for p in parents:
+        p.update_encoding()
+    hashes = [p.genotype_hash() for p in parents]
+    for i in range(num_ops):
+        child1, child2 = GA_crossover(*parents)
+        assert child1 is not parents[0] and child2 is not parents[1], "Should be True if the children are new encodings"
+        offspring = parents[0].clone()
+        GA_mutation(offspring)
+        dsge_mutation(offspring)
+    assert [p.genotype_hash() for p in parents] == hashes, "Should be True if the parents were never changed"
+
+
+def test_grammar_registry():
+    print(bcolors.HEADER + "\nTesting that all the modules share one grammar, also after copy and pickle" + bcolors.ENDC)
+    netcode = generate_random_net()
+    grammars = {id(module.grammar) for module in netcode.modules() + generate_random_net().modules()}
+    assert len(grammars) == 1, "Should be True if the grammar file is read once"
+    twin = pickle.loads(pickle.dumps(copy.deepcopy(netcode)))
+    assert twin.features[0].grammar is netcode.features[0].grammar, "Should be True if copies refer to the registry"
+
+
+def test_compact_genotype(num_net = 50):
+    print(bcolors.HEADER + "\nTesting the round trip through the compact genotype and its binary format" + bcolors.ENDC)
+    for i in range(num_net):
+        netcode = generate_random_net()
+        if i % 2:
+            netcode.setting_channels()
+        data = compact(netcode).to_bytes()
+        twin = from_bytes(data).to_encoding()
+        assert twin.genotype_hash() == netcode.genotype_hash(), "Should be True if the network is the same"
+        assert compact(twin).to_bytes() == data, "Should be True if the conversion is lossless"
+        assert len(data) < len(pickle.dumps(netcode)), "Should be True if the compact form is smaller than the pickle"
+
+
+def test_runlog(num_gen = 3, population_size = 4):
+    print(bcolors.HEADER + "\nTesting the run log: chunks, genotypes and resume with pending generations" + bcolors.ENDC)
+    nets = []
+    while len(nets) < population_size:
+        netcode = generate_random_net()
+        if netcode.repair()[0]:
+            nets.append(netcode)
+    stats = [{'individual': j, 'score': float(j), 'len': x._len(), 'genotype': x, 'cost': x.cost()} for j, x in enumerate(nets)]
+
+    path = tempfile.mkdtemp()
+    log = RunLog(path)
+    for i in range(num_gen):
+        log.append(i, make_batch(i, stats, population_size - 1, nets[-1]))
+    log.close()
+    columns = read_runlog(path)
+    assert columns['generation'].tolist() == [i for i in range(num_gen) for _ in nets], "Should be True if every generation is logged once"
+    assert [x.genotype_hash() for x in genotypes(columns)] == [x.genotype_hash() for x in nets] * num_gen, "Should be True if the genotypes are kept"
+
+    # a checkpoint of generation 0 saved while generation 1 was still in the queue
+    log = RunLog(path, resume_after=0, pending=[(1, make_batch(1, stats, 0, nets[0]))])
+    log.close()
+    assert sorted(set(read_runlog(path)['generation'].tolist())) == [0, 1], "Should be True if the later generations are dropped"
+
+
+def benchmark_crossover(num_ops = 10000, population_size = 100):
+    print(bcolors.HEADER + f"\nBenchmark of {num_ops} crossovers with shared modules and with copied parents" + bcolors.ENDC)
+    population = [generate_random_net() for _ in range(population_size)]
+    pairs = [(population[np.random.randint(population_size)], population[np.random.randint(population_size)]) for _ in range(num_ops)]
+
+    results = {}
+    for name, operator in [('shared', lambda a, b: GA_crossover(a, b)),
+                           ('deepcopy', lambda a, b: GA_crossover(copy.deepcopy(a), copy.deepcopy(b)))]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        children = [operator(a, b) for a, b in pairs]
+        elapsed = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results[name] = elapsed
+        print(bcolors.ALT + f"{name}: {elapsed:.2f}s, {memory / 2**20:.1f} MiB for the children" + bcolors.ENDC)
+        del children
+    assert results['shared'] < results['deepcopy'], "Should be True if sharing the modules is faster than copying them"
+
+
+def test_shape_analysis(trainloader, num_net = 100):
+    print(bcolors.HEADER + "\nTesting the static shape analysis against the real forward pass" + bcolors.ENDC)
+    inputs, _ = next(iter(trainloader))
+    for i in range(num_net):
+        netcode = generate_random_net()
+        valid, reason = netcode.repair()
+        if not valid:
+            print(bcolors.ALT + "Network rejected: " + reason + bcolors.ENDC)
+            continue
+
+        trace, _ = netcode.shape_trace()
+        model = Net(netcode)
+        x = inputs
+        expected = iter(trace)
+        for layer in model.layer_list:
+            x = layer(x)
+            if isinstance(layer, nn.Flatten):
+                continue
+            shape = (x.shape[1], x.shape[2]) if x.dim() == 4 else (x.shape[1],)
+            assert next(expected)['out'] == shape, "Should be True if the static shape is the real one"
+
+
+def test_broker(dataset, num_workers = 2, num_net = 6):
+    print(bcolors.HEADER + "\nTesting the spool broker with a worker killed while training" + bcolors.ENDC)
+    spool = tempfile.mkdtemp()
+    start = lambda: subprocess.Popen([sys.executable, '-m', 'src.broker', spool], stdout=subprocess.DEVNULL)
+    evaluator = SpoolEvaluator(spool, dataset, 4, stale_after=15)
+    futures = [evaluator.submit(generate_random_net(), fraction=0.05) for _ in range(num_net)]
+
+    # the victim starts alone, it is killed while it owns a task; the others start after it
+    victim = start()
+    owned = lambda: [name for name in os.listdir(os.path.join(spool, 'running')) if name.endswith(f"-{victim.pid}.pkl")]
+    while not owned():
+        time.sleep(0.1)
+    victim.kill()
+    victim.wait()
+    workers = [start() for _ in range(num_workers - 1)]
+
+    results = [f.result() for f in futures]
+    assert evaluator.requeued == 1, "Should be True if the task of the killed worker was reassigned"
+    assert len(results) == num_net and all(score >= 0 for score, _ in results), "Should be True if every task is completed by the other workers"
+    # a cancelled task is withdrawn, close does not wait for its training
+    evaluator.submit(generate_random_net(), fraction=0.05).cancel()
+    assert not evaluator.futures, "Should be True if the cancelled task is forgotten"
+    evaluator.close()
+    assert not os.listdir(os.path.join(spool, 'results')) and not evaluator.futures, "Should be True if every result arrived exactly once"
+    assert all(w.wait() == 0 for w in workers), "Should be True if the workers exit when the coordinator closes"
+
+
+def test_pareto():
+    print(bcolors.HEADER + "\nTesting the NSGA-II fronts on hand-made (-accuracy, cost) points" + bcolors.ENDC)
+    points = [(-90, 10), (-80, 5), (-70, 1), (-80, 10), (-60, 20), (-90, 10)]
+    fronts = non_dominated_sort(points)
+    assert fronts == [[0, 1, 2, 5], [3], [4]], "Should be True if duplicates share the first front"
+    distance = crowding_distance(points, fronts[0])
+    assert distance[2] == np.inf and distance[1] < np.inf, "Should be True if only the extremes are infinitely far"
+    order = nsga2_order(points)
+    assert order[-2:] == [3, 4], "Should be True if the dominated networks come last"
+    # a cheap network which was never trained would be on the first front
+    order = nsga2_order(points + [(0, 0)], [True] * len(points) + [False])
+    assert order[-1] == len(points), "Should be True if the networks without a real accuracy come last"
+    # every network of the generation was aborted, nothing is archived
+    assert nsga2_order([(0, 5), (0, 1)], [False, False]) == [0, 1], "Should be True if the order is kept without valid networks"
+    assert ParetoArchive().update([]) == 0, "Should be True if an empty archive stays empty"
+
+
 '''
 auxiliary functions
 '''